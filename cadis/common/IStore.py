@@ -5,22 +5,67 @@ Created on Dec 14, 2015
 '''
 
 import abc
+from copy import copy
+
+class Delta(object):
+    '''
+    Properties of an object changed since a reader last read it, found in
+    the updated lists of getupdated(..., deltas=True) in place of the whole
+    object. props: { property_name : property_value }
+    '''
+    __slots__ = ("_primarykey", "_version", "props")
+
+    def __init__(self, primkey, version, props):
+        self._primarykey = primkey
+        self._version = version
+        self.props = props
+
+    def apply(self, obj):
+        '''
+        Copy of obj (an object or an older Delta) with the changes applied.
+        '''
+        if isinstance(obj, Delta):
+            props = dict(obj.props)
+            props.update(self.props)
+            return Delta(self._primarykey, self._version, props)
+        res = copy(obj)
+        for name, value in self.props.items():
+            setattr(res, name, value)
+        res._version = self._version
+        return res
 
 class IStore(object):
     __metaclass__ = abc.ABCMeta
-
+
     @abc.abstractmethod
     def insert(self, obj):
         return
-
+
     @abc.abstractmethod
     def get(self, typeObj):
         return
-
+
     @abc.abstractmethod
     def close(self):
         return
-
+
     @abc.abstractmethod
     def delete(self, typeObj, primkey):
         return
+
+    @abc.abstractmethod
+    def insert_all(self, t, objs, sim):
+        '''
+        Inserts objs of type t in one call: readers see all of them or none.
+        If an object is of an unknown type, or its key is in the store or twice
+        in objs, none of them is inserted and ValueError is raised.
+        '''
+        return
+
+    @abc.abstractmethod
+    def delete_all(self, t, primkeys, sim):
+        '''
+        Deletes the objects of type t with primkeys in one call: readers see
+        all of them deleted or none.
+        '''
+        return
@@ -0,0 +1,115 @@
+'''
+Fixed memory latency histograms.
+
+Latencies are counted in log-linear buckets, in the style of HdrHistogram:
+every power of two of microseconds is split in SUB_BUCKETS linear buckets,
+so a recorded value is known to within 100 / SUB_BUCKETS percent whatever
+its magnitude. Recording is an index computation and an increment, and a
+histogram takes the same memory after a million samples as after one.
+'''
+import threading
+
+# Linear buckets per power of two, half of 2 ** SUB_BITS
+SUB_BITS = 6
+SUB_BUCKETS = 1 << (SUB_BITS - 1)
+# Largest value tracked, in microseconds (2 ** 36 us is about 19 hours)
+MAX_BITS = 36
+BUCKETS = (1 << SUB_BITS) + (MAX_BITS - SUB_BITS) * SUB_BUCKETS
+
+PERCENTILES = (50, 95, 99)
+
+def bucket_of(us):
+    if us < (1 << SUB_BITS):
+        return us
+    shift = us.bit_length() - SUB_BITS
+    if shift > MAX_BITS - SUB_BITS:
+        return BUCKETS - 1
+    # us >> shift is in [SUB_BUCKETS, 2 * SUB_BUCKETS)
+    return (1 << SUB_BITS) + (shift - 1) * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS
+
+def value_of(bucket):
+    # Highest value counted in a bucket, in microseconds
+    if bucket < (1 << SUB_BITS):
+        return bucket
+    shift, sub = divmod(bucket - (1 << SUB_BITS), SUB_BUCKETS)
+    shift += 1
+    return ((sub + SUB_BUCKETS + 1) << shift) - 1
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        # Not locked: a sample lost to a race is of no consequence here
+        self.counts[bucket_of(int(ms * 1000))] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        '''
+        Latency in ms that p percent of the samples did not exceed.
+        '''
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(value_of(bucket) / 1000.0, self.max)
+        return self.max
+
+    def merge(self, other):
+        for bucket, n in enumerate(other.counts):
+            if n:
+                self.counts[bucket] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        res = {
+            "count" : self.count,
+            "mean" : self.total / self.count if self.count else 0.0,
+            "max" : self.max
+        }
+        for p in PERCENTILES:
+            res["p%d" % p] = self.percentile(p)
+        return res
+
+class Histograms(object):
+    '''
+    LatencyHistograms by operation name, created on first use.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, ms):
+        h = self.histograms.get(name)
+        if h is None:
+            with self.lock:
+                h = self.histograms.setdefault(name, LatencyHistogram())
+        h.record(ms)
+
+    def summary(self):
+        return {name : h.summary() for name, h in self.histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+def format_summary(summary):
+    '''
+    Table of the summaries of a Histograms, one operation per line.
+    '''
+    lines = ["%-36s %8s %9s %9s %9s %9s" % ("operation (ms)", "count", "p50", "p95", "p99", "max")]
+    for name in sorted(summary):
+        s = summary[name]
+        lines.append("%-36s %8d %9.3f %9.3f %9.3f %9.3f" % (name, s["count"], s["p50"], s["p95"], s["p99"], s["max"]))
+    return "\n".join(lines)
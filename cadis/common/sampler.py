@@ -0,0 +1,80 @@
+'''
+Statistical sampling profiler for a running connector.
+
+A background thread looks at the stack of the profiled thread every
+interval seconds and counts how often each stack was seen. Nothing is
+hooked into the profiled code, so the overhead is the sampling thread's
+share of the interpreter, and the profiler may be started and stopped at
+any time. The counts are written as collapsed stacks, one
+"frame;frame;...;frame count" line per stack with the outermost frame
+first, the input of flamegraph.pl and speedscope.
+'''
+import os
+import sys
+import threading
+import time
+
+# Seconds between two samples
+SAMPLE_INTERVAL = 0.005
+
+def frame_name(f):
+    co = f.f_code
+    return "%s:%s" % (os.path.basename(co.co_filename), co.co_name)
+
+class SamplingProfiler(object):
+    def __init__(self, ident=None, interval=SAMPLE_INTERVAL):
+        '''
+        ident: thread to profile, the calling thread by default
+        '''
+        self.ident = ident if ident is not None else threading.current_thread().ident
+        self.interval = interval
+        # Collapsed stack -> samples
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread:
+            return
+        self.stopping.clear()
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, name="sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            f = sys._current_frames().get(self.ident)
+            if f is None:
+                # The profiled thread is gone
+                return
+            names = []
+            while f is not None:
+                names.append(frame_name(f))
+                f = f.f_back
+            names.reverse()
+            stack = ";".join(names)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def dump(self, fname):
+        with open(fname, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+    def clear(self):
+        self.stacks = {}
+        self.samples = 0
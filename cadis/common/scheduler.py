@@ -0,0 +1,147 @@
+'''
+Deadline based tick scheduler used by the frame's TimerThread.
+
+Tick n is due at start + n * interval, so time spent in the ticks and in
+sleeping does not accumulate as drift. When a tick starts after its
+deadline has passed by a whole interval or more, the overrun policy
+decides what happens to the missed deadlines:
+
+- catchup: the missed ticks run back to back until the schedule is met
+  again, keeping world time (one step per tick) aligned with wall clock.
+  At most maxburst ticks are run late in a row; older deadlines are
+  dropped and counted as skipped.
+- skip: the missed deadlines are dropped and the next tick waits for the
+  next deadline. World time falls behind by the skipped ticks.
+- stretch: the whole schedule is moved back by the overrun. World time
+  runs slower than wall clock for as long as the ticks overrun.
+
+In lock-step mode there is no schedule: the frames run their ticks as fast
+as they can, meeting at a TickBarrier.
+'''
+import multiprocessing
+import time
+
+CATCHUP = "catchup"
+SKIP = "skip"
+STRETCH = "stretch"
+POLICIES = (CATCHUP, SKIP, STRETCH)
+
+# Seconds per tick when General "Interval" is not set. BaseConnector uses
+# the same default for the world time of a simulation step.
+DEFAULT_INTERVAL = 0.150
+
+class TickScheduler(object):
+    def __init__(self, interval, policy=CATCHUP, maxburst=5, clock=time.time, sleep=time.sleep):
+        if policy not in POLICIES:
+            raise ValueError("unknown overrun policy %s, expected one of %s" % (policy, ", ".join(POLICIES)))
+        self.interval = interval
+        self.policy = policy
+        self.maxburst = maxburst
+        self.clock = clock
+        self.sleep = sleep
+        self.start = None
+        # Index of the next tick on the schedule
+        self.slot = 0
+        # Ticks run late in a row
+        self.burst = 0
+
+        # Lag metrics
+        # Seconds the last tick started behind the schedule, once the policy
+        # was applied
+        self.lag = 0.0
+        # Most seconds a tick started after its deadline
+        self.maxlag = 0.0
+        # Ticks that started a whole interval or more late
+        self.overruns = 0
+        # Deadlines dropped (skip, or catchup beyond maxburst)
+        self.skipped = 0
+        # Seconds the schedule was moved back (stretch)
+        self.stretched = 0.0
+
+    def begin(self):
+        self.start = self.clock()
+        self.slot = 0
+
+    def resume(self):
+        # After a pause: the next tick is due now, nothing was missed
+        self.start = self.clock() - self.slot * self.interval
+        self.burst = 0
+
+    def deadline(self):
+        return self.start + self.slot * self.interval
+
+    def wait(self):
+        '''
+        Waits for the deadline of the next tick, applying the overrun policy
+        if it passed already. Returns the lag of the tick in seconds.
+        '''
+        if self.start is None:
+            self.begin()
+        now = self.clock()
+        lag = now - self.deadline()
+        self.maxlag = max(self.maxlag, lag)
+        if lag < 0:
+            self.sleep(-lag)
+            lag = 0.0
+            self.burst = 0
+        elif lag >= self.interval:
+            self.overruns += 1
+            # Rounded so that float error does not leave a deadline behind
+            missed = int(lag / self.interval + 1e-9)
+            if self.policy == SKIP:
+                self.drop(missed)
+            elif self.policy == STRETCH:
+                self.start += lag
+                self.stretched += lag
+            else:
+                self.burst += 1
+                if self.burst > self.maxburst:
+                    self.drop(missed)
+                    self.burst = 0
+            lag = max(0.0, now - self.deadline())
+        else:
+            self.burst = 0
+        self.lag = lag
+        self.slot += 1
+        return lag
+
+    def drop(self, missed):
+        self.slot += missed
+        self.skipped += missed
+
+    def summary(self):
+        return "lag %.1f ms (max %.1f ms), %d overruns, %d ticks skipped, %.3f s stretched" % \
+            (self.lag * 1000, self.maxlag * 1000, self.overruns, self.skipped, self.stretched)
+
+class TickBarrier(object):
+    '''
+    Barrier the frames of a lock-step run meet at, so they all go through
+    each phase of a tick together. Built on multiprocessing primitives, so
+    that connectors may run in threads or in processes; it must be created
+    before the processes are started.
+    '''
+    def __init__(self, parties):
+        self.parties = parties
+        self.cond = multiprocessing.Condition()
+        self.count = multiprocessing.Value('i', 0, lock=False)
+        self.generation = multiprocessing.Value('i', 0, lock=False)
+
+    def wait(self, abort=None, poll=0.5):
+        '''
+        Blocks until all parties called wait. Returns False if abort()
+        became true while waiting (the simulation paused or is shutting down).
+        '''
+        with self.cond:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.cond.notify_all()
+                return True
+            while generation == self.generation.value:
+                self.cond.wait(poll)
+                if generation == self.generation.value and abort and abort():
+                    self.count.value -= 1
+                    return False
+            return True
@@ -0,0 +1,130 @@
+'''
+Trace events timeline, in the Chrome trace event format (chrome://tracing,
+ui.perfetto.dev).
+
+Each process traces to its own file, stats/<time>_trace_<name>_<pid>.json:
+complete events ("ph": "X") of the spans run by its threads, timed with the
+wall clock so that the files of the connectors and of the frame server line
+up. Spans carry the tick they belong to, and remote stores send the tick to
+the frame server (X-CADIS-Tick), so a store request is found next to the
+tick that made it. scripts/mergetrace joins the files into one timeline.
+
+Tracing is off until start is called; spans then cost a clock read and a
+deque append, and nothing otherwise.
+'''
+import atexit
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import threading
+import time
+
+from cadis.common.util import BufferedWriter
+
+# The process' tracer, None when not tracing
+tracer = None
+
+# Tick of the frame running on the current thread
+current = threading.local()
+
+class TraceWriter(BufferedWriter):
+    def __init__(self, fname):
+        super(TraceWriter, self).__init__(fname)
+        # An unterminated array is a valid trace, so events are appended as
+        # they come and the file is readable at any point
+        self.file.write("[\n")
+
+    def write_rows(self, f, rows):
+        f.write("".join(json.dumps(event) + ",\n" for event in rows))
+
+class Tracer(object):
+    def __init__(self, name):
+        self.pid = os.getpid()
+        if not os.path.exists('stats'):
+            os.mkdir('stats')
+        self.fname = os.path.join('stats', "%s_trace_%s_%d.json" % (time.strftime("%Y-%m-%d_%H-%M-%S"), name, self.pid))
+        self.writer = TraceWriter(self.fname)
+        self.metadata("process_name", 0, name)
+
+    def metadata(self, kind, tid, name):
+        self.writer.write({"name" : kind, "ph" : "M", "pid" : self.pid, "tid" : tid, "args" : {"name" : name}})
+
+    def span(self, name, start, end, cat, args=None):
+        event = {"name" : name, "cat" : cat, "ph" : "X", "pid" : self.pid,
+                 "tid" : threading.current_thread().ident,
+                 "ts" : start * 1000000, "dur" : (end - start) * 1000000}
+        tick = getattr(current, "tick", None)
+        if tick is not None or args:
+            event["args"] = dict(args or {})
+            if tick is not None:
+                event["args"].setdefault("tick", tick)
+        self.writer.write(event)
+
+    def close(self):
+        self.writer.close()
+
+def start(name):
+    '''
+    Starts tracing the process, if not already. Processes forked from a
+    tracing process start their own trace.
+    '''
+    global tracer
+    if tracer is None or tracer.pid != os.getpid():
+        tracer = Tracer(name)
+    return tracer
+
+def stop():
+    global tracer
+    if tracer is not None and tracer.pid == os.getpid():
+        tracer.close()
+    tracer = None
+
+# Processes forked by multiprocessing exit without running this, and call
+# flush when done instead
+atexit.register(stop)
+
+def flush():
+    if tracer is not None:
+        tracer.writer.flush()
+
+def name_thread(name):
+    # Labels the calling thread's track in the timeline
+    if tracer is not None:
+        tracer.metadata("thread_name", threading.current_thread().ident, name)
+
+def set_tick(tick):
+    current.tick = tick
+
+def record(name, start, end, cat="cadis", args=None):
+    if tracer is not None:
+        tracer.span(name, start, end, cat, args)
+
+@contextmanager
+def span(name, cat="cadis", args=None):
+    if tracer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        tracer.span(name, start, time.time(), cat, args)
+
+def traced(name=None, cat="cadis"):
+    '''
+    Decorator tracing every call of the function as a span.
+    '''
+    def decorator(f):
+        spanname = name or f.__name__
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            if tracer is None:
+                return f(*args, **kwds)
+            start = time.time()
+            try:
+                return f(*args, **kwds)
+            finally:
+                tracer.span(spanname, start, time.time(), cat)
+        return wrapper
+    return decorator
@@ -4,12 +4,16 @@ Created on Mar 7, 2016
 
 @author: arthur
 '''
+import abc
+from collections import deque
 from functools import wraps
+import logging
 import time
 import csv
 import os
 import platform
 import sys
+from threading import Thread, Event, Lock
 
 sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
 from cadis.common.IFramed import IFramed
@@ -17,6 +21,82 @@ from cadis.common.IFramed import IFramed
 INSTRUMENT = True
 INSTRUMENT_HEADERS = {}
 
+# Rows a BufferedWriter holds before dropping the oldest ones
+STATS_CAPACITY = 10000
+# Seconds between two flushes of a BufferedWriter
+STATS_FLUSH_INTERVAL = 2.0
+
+class BufferedWriter(object):
+    '''
+    Writes rows to a file off the caller's thread.
+
+    Rows are appended to an in-memory ring buffer and written in batches by
+    a background thread, every interval seconds or when flush is called.
+    The buffer holds at most capacity rows: if the writer falls behind, the
+    oldest rows are dropped and counted. close() writes whatever is left.
+    Subclasses define how a batch of rows is written (write_rows).
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, fname, capacity=STATS_CAPACITY, interval=STATS_FLUSH_INTERVAL):
+        self.__Logger = logging.getLogger(__name__)
+        self.fname = fname
+        self.file = open(fname, 'a')
+        self.rows = deque(maxlen=capacity)
+        self.interval = interval
+        self.dropped = 0
+        self.lock = Lock()
+        self.closing = Event()
+        self.thread = Thread(target=self.run, name="writer %s" % os.path.basename(fname))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, row):
+        # deque appends are atomic, the row is not touched after this
+        if len(self.rows) == self.rows.maxlen:
+            self.dropped += 1
+        self.rows.append(row)
+
+    def run(self):
+        while not self.closing.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = []
+            while self.rows:
+                batch.append(self.rows.popleft())
+            if batch:
+                try:
+                    self.write_rows(self.file, batch)
+                    self.file.flush()
+                except Exception:
+                    self.__Logger.exception("%s: could not write %d rows", self.fname, len(batch))
+
+    @abc.abstractmethod
+    def write_rows(self, f, rows):
+        return
+
+    def close(self):
+        self.closing.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        if self.dropped:
+            self.__Logger.warn("%s: dropped %d rows, the writer could not keep up", self.fname, self.dropped)
+
+class StatsWriter(BufferedWriter):
+    '''
+    Writes instrumentation rows to a CSV file off the simulation loop.
+    '''
+    def __init__(self, fname, fieldnames, capacity=STATS_CAPACITY, interval=STATS_FLUSH_INTERVAL):
+        self.fieldnames = fieldnames
+        super(StatsWriter, self).__init__(fname, capacity, interval)
+        self.writer = csv.DictWriter(self.file, delimiter=',', lineterminator='\n', fieldnames=fieldnames)
+
+    def write_rows(self, f, rows):
+        self.writer.writerows(rows)
+
 def instrument_average(f):
     if not INSTRUMENT:
         return f
@@ -35,6 +115,8 @@ def instrument_average(f):
             if obj._instruments[f.__name__] == "":
                 obj._instruments[f.__name__] = []
             obj._instruments[f.__name__].append((end - start) * 1000)
+            if hasattr(obj, 'latency'):
+                obj.latency.record(f.__name__, (end - start) * 1000)
             return ret
         return instrument
 
@@ -56,6 +138,8 @@ def instrument(f):
             if obj._instruments[f.__name__] == "":
                 obj._instruments[f.__name__] = 0
             obj._instruments[f.__name__] += (end - start) * 1000
+            if hasattr(obj, 'latency'):
+                obj.latency.record(f.__name__, (end - start) * 1000)
             return ret
         return instrument
 
@@ -84,6 +168,7 @@ class Instrument(object):
             self.fieldnames = self.headers
             writer = csv.DictWriter(csvfile, delimiter=',', lineterminator='\n', fieldnames=self.fieldnames)
             writer.writeheader()
+        self.writer = StatsWriter(self.ifname, self.fieldnames)
 
     def clean(self):
         for k in self.instruments:
@@ -99,17 +184,18 @@ class Instrument(object):
         self.instruments[header] = (end - start) * 1000
 
     def dump_stats(self):
-        with open(self.ifname, 'a', 0) as csvfile:
-            writer = csv.DictWriter(csvfile, delimiter=',', lineterminator='\n', fieldnames=self.fieldnames)
-            #d['vehicles'] = self.frame.count(self.frame.name2class("Vehicle"))
-            self.instruments['iteration'] = self.iteration
-            for h in self.instruments:
-                # if averaging, calculate it
-                if isinstance(self.instruments[h], list):
-                    if len(self.instruments[h]) == 0:
-                        self.instruments[h] = ""
-                    else:
-                        self.instruments[h] = float(sum(self.instruments[h]))/len(self.instruments[h])
-            writer.writerow(self.instruments)
-            self.clean()
-            self.iteration += 1
+        #d['vehicles'] = self.frame.count(self.frame.name2class("Vehicle"))
+        self.instruments['iteration'] = self.iteration
+        for h in self.instruments:
+            # if averaging, calculate it
+            if isinstance(self.instruments[h], list):
+                if len(self.instruments[h]) == 0:
+                    self.instruments[h] = ""
+                else:
+                    self.instruments[h] = float(sum(self.instruments[h]))/len(self.instruments[h])
+        self.writer.write(dict(self.instruments))
+        self.clean()
+        self.iteration += 1
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,45 @@
+'''
+WSGI server with a fixed pool of worker threads, used by the frame server.
+
+werkzeug's development server either handles one request at a time or
+starts a new thread per request. PooledWSGIServer accepts connections on
+the main thread and hands them to a configurable number of workers, so
+requests from several simulators are served concurrently without paying
+for a thread per request.
+'''
+import Queue
+from threading import Thread
+
+from werkzeug.serving import BaseWSGIServer
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, workers=16, **kwargs):
+        '''
+        workers: number of requests served at the same time. Long-poll
+        subscriptions hold a worker while they wait, so this should be
+        larger than the number of subscribing simulators.
+        '''
+        BaseWSGIServer.__init__(self, host, port, app, **kwargs)
+        self.requests = Queue.Queue()
+        self.workers = []
+        for i in range(workers):
+            t = Thread(target=self.work, name="wsgi-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def process_request(self, request, client_address):
+        # Called on the accepting thread: queue the connection for a worker
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
@@ -5,6 +5,7 @@ Created on Dec 14, 2015
 '''
 
 import cProfile
+from contextlib import contextmanager
 from copy import deepcopy, copy
 import csv
 from functools import wraps
@@ -12,11 +13,18 @@ import logging, sys
 from multiprocessing import Process
 import os
 import platform
+import Queue
 from threading import Timer, Thread
 import time
 import uuid
 
 from cadis.common.IFramed import IFramed
+from cadis.common.IStore import Delta
+from cadis.common.histogram import Histograms
+from cadis.common.sampler import SamplingProfiler
+from cadis.common import tracing
+from cadis.common.util import StatsWriter
+from cadis.common.scheduler import TickScheduler, CATCHUP, DEFAULT_INTERVAL
 from cadis.language.schema import schema_data, CADISEncoder, subsetsof, \
     setsof, sets as schema_sets, subsets as schema_subsets, permutationsets as schema_permutationsets, \
     CADIS
@@ -30,9 +38,13 @@ logger = logging.getLogger(__name__)
 LOG_HEADER = "[FRAME]"
 
 USE_REMOTE_STORE = True # TODO Convert C# server to accept Strings instead of Integer
-DEBUG = True
+# Runs the whole simulation loop under cProfile. Slows the loop several
+# times; the controller's profile command samples a running connector instead
+DEBUG = False
 INSTRUMENT = True
 INSTRUMENT_HEADERS = {}
+# Seconds between two publications of a frame's latency summary
+LATENCY_PUBLISH_INTERVAL = 1.0
 
 # SimulatorStartup = False
 # SimulatorShutdown = False
@@ -58,12 +70,22 @@ class TimerThread(object) :
         self.appname = self.frame.app._appname
         self.CurrentIteration = 0
         self.timer = timer
+        general = self.frame.settings["General"] if self.frame.settings else {}
         if self.frame.interval:
             self.IntervalTime = self.frame.interval
         else:
-            self.IntervalTime = 0.2
+            # One tick per simulation step
+            self.IntervalTime = float(general.get("Interval", DEFAULT_INTERVAL))
 
         self.Clock = time.time
+        self.scheduler = TickScheduler(self.IntervalTime, general.get("OverrunPolicy", CATCHUP),
+                                       int(general.get("MaxCatchupTicks", 5)), self.Clock)
+        # Number of ticks to run, 0 for no limit
+        self.TimeSteps = int(general.get("TimeSteps", 0))
+        # Sampling profiler, while the controller has it on (see check_profiler)
+        self.sampler = None
+        # Trace events timeline (see cadis.common.tracing)
+        self.trace = bool(general.get("Trace", False))
 
     # -----------------------------------------------------------------
     def run(self) :
@@ -79,10 +101,9 @@ class TimerThread(object) :
         if self.frame.settings:
             maxt = self.frame.settings["General"].get("MaximumTravelers", None)
 
-        # timer can be set to stop the simulation automatically at a configured time
-        if self.timer:
-            # save start time, for checking when the application should be stopped
-            self.exec_start = datetime.datetime.now()
+        # save start time, for the instrumentation and for checking when the
+        # application should be stopped if a timer is set
+        self.exec_start = datetime.datetime.now()
 
         strtime = time.strftime("%Y-%m-%d_%H-%M-%S")
         if DEBUG:
@@ -107,7 +128,7 @@ class TimerThread(object) :
                               (self.frame.process, maxt, self.IntervalTime, self.timer, type(Frame.Store).__name__))
                 csvfile.write("########\n\n")
                 # Base headers
-                headers = ['time', 'delta', 'nobjects', 'mem buffer', 'vehicles']
+                headers = ['time', 'delta', 'lag', 'skipped', 'nobjects', 'mem buffer', 'vehicles']
                 # Annotated headers
                 headers.extend(INSTRUMENT_HEADERS[self.frame.__module__])
                 headers.extend(INSTRUMENT_HEADERS[self.frame.app.__module__])
@@ -115,7 +136,13 @@ class TimerThread(object) :
                 self.fieldnames = headers
                 writer = csv.DictWriter(csvfile, delimiter=',', lineterminator='\n', fieldnames=self.fieldnames)
                 writer.writeheader()
+            self.stats = StatsWriter(self.ifname, self.fieldnames)
+            self.published = 0
 
+        if self.trace:
+            # Connectors running as threads share their process' trace
+            tracing.start(self.appname if self.frame.process else "connectors")
+            tracing.name_thread(self.appname)
 
         # Start the main simulation loop
         self.__Logger.debug("start main simulation loop")
@@ -123,37 +150,53 @@ class TimerThread(object) :
 
         self.CurrentIteration = 0
         schema_data.frame = self.frame
+        if self.frame.barrier:
+            # The first tick starts once every frame pushed its initial objects
+            self.frame.barrier.wait(self.frame.shutting_down)
+        self.scheduler.begin()
 
         try:
             while not self.cmds["SimulatorShutdown"]:
+                self.check_profiler()
                 if self.cmds["SimulatorPaused"]:
                     time.sleep(self.IntervalTime)
+                    self.scheduler.resume()
                     continue
 
+                if not self.frame.barrier:
+                    # In lock-step mode ticks run as fast as the slowest frame
+                    self.scheduler.wait()
                 stime = self.Clock()
+                tracing.set_tick(self.CurrentIteration)
                 self.frame.execute_Frame()
 
                 etime = self.Clock()
+                tracing.record("tick", stime, etime)
                 delta_secs = (etime - stime)
 
                 if INSTRUMENT:
-                    with open(self.ifname, 'a', 0) as csvfile:
-                    # csv.writer(["%.3f" % delta].append(self.inst_array))
-                        writer = csv.DictWriter(csvfile, delimiter=',', lineterminator='\n', fieldnames=self.fieldnames)
-                        d = self.frame._instruments
-                        d['time'] = str(datetime.datetime.now() - self.exec_start)
-                        d['delta'] = delta_secs * 1000
-                        d['vehicles'] = self.frame.count(self.frame.name2class("Vehicle"))
-                        if self.CurrentIteration % 10 == 0:
-                            d['nobjects'], d['mem buffer'] = self.frame.buffersize()
-                        writer.writerow(d)
-                        self.frame._instruments = {}
-                if delta_secs < self.IntervalTime :
-                    time.sleep(self.IntervalTime - delta_secs)
-                else:
+                    d = self.frame._instruments
+                    d['time'] = str(datetime.datetime.now() - self.exec_start)
+                    d['delta'] = delta_secs * 1000
+                    d['lag'] = self.scheduler.lag * 1000
+                    d['skipped'] = self.scheduler.skipped
+                    d['vehicles'] = self.frame.count(self.frame.name2class("Vehicle"))
+                    if self.CurrentIteration % 10 == 0:
+                        d['nobjects'], d['mem buffer'] = self.frame.buffersize()
+                    # Written in the background, the frame starts a new dict
+                    self.stats.write(d)
+                    self.frame._instruments = {}
+                    self.frame.latency.record('tick', d['delta'])
+                    self.frame.latency.record('lag', d['lag'])
+                    if etime - self.published >= LATENCY_PUBLISH_INTERVAL:
+                        self.frame.publish_latency()
+                        self.published = etime
+                if delta_secs >= self.IntervalTime and not self.frame.barrier :
                     self.__Logger.warn("[%s]: Exceeded interval time by %s at iteration %s" , self.frame.app.__module__, delta_secs * 1000, self.CurrentIteration)
 
                 self.CurrentIteration += 1
+                if self.TimeSteps and self.CurrentIteration >= self.TimeSteps:
+                    self.cmds["SimulatorShutdown"] = True
 
                 # if a timer is set and we have run for the designated, send the shutdown message.
                 if self.timer:
@@ -161,6 +204,11 @@ class TimerThread(object) :
                     if d > self.timer:
                         self.cmds["SimulatorShutdown"] = True
         finally:
+            if self.sampler:
+                self.stop_profiler()
+            if INSTRUMENT:
+                self.stats.close()
+                self.frame.publish_latency()
             if DEBUG:
                 self.profile.disable()
                 self.profile.create_stats()
@@ -170,10 +218,70 @@ class TimerThread(object) :
         elapsed = self.Clock() - starttime
         avginterval = 1000.0 * elapsed / self.CurrentIteration
         self.__Logger.warn("%d iterations completed with an elapsed time %f or %f ms per iteration", self.CurrentIteration, elapsed, avginterval)
+        self.__Logger.warn("[%s]: %s", self.frame.app.__module__, self.scheduler.summary())
 
         self.frame.stop()
+        # Forked processes exit without running the writer's last flush
+        tracing.flush()
         # self.cmds["SimulatorShutdown"] = True
 
+    def check_profiler(self):
+        # PROFILE_<app> holds the sampling interval in ms while the
+        # controller has the profiler on
+        interval = self.cmds.get("PROFILE_" + self.appname)
+        if interval and not self.sampler:
+            self.sampler = SamplingProfiler(interval=interval / 1000.0)
+            self.sampler_start = self.CurrentIteration
+            self.sampler.start()
+            self.__Logger.warn("[%s]: sampling profiler started at iteration %d", self.appname, self.CurrentIteration)
+        elif not interval and self.sampler:
+            self.stop_profiler()
+
+    def stop_profiler(self):
+        self.sampler.stop()
+        if not os.path.exists('stats'):
+            os.mkdir('stats')
+        fname = os.path.join('stats', "%s_%s_%d-%d.folded" % (time.strftime("%Y-%m-%d_%H-%M-%S"), self.appname,
+                                                               self.sampler_start, self.CurrentIteration))
+        self.sampler.dump(fname)
+        self.__Logger.warn("[%s]: %d samples of iterations %d to %d written to %s", self.appname,
+                           self.sampler.samples, self.sampler_start, self.CurrentIteration, fname)
+        self.sampler = None
+
+class IOWorker(object):
+    '''
+    Background thread of a pipelined frame, running one store exchange at
+    a time (see Frame.execute_pipelined).
+    '''
+    def __init__(self, name):
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.pending = False
+        self.name = name
+        t = Thread(target=self.run, name=name)
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        tracing.name_thread(self.name)
+        while True:
+            f, args = self.jobs.get()
+            try:
+                self.results.put((True, f(*args)))
+            except Exception:
+                self.results.put((False, sys.exc_info()))
+
+    def submit(self, f, *args):
+        self.pending = True
+        self.jobs.put((f, args))
+
+    def result(self):
+        self.pending = False
+        ok, res = self.results.get()
+        if not ok:
+            raise res[0], res[1], res[2]
+        return res
+
 def instrument(f):
     if not INSTRUMENT:
         return f
@@ -194,6 +302,9 @@ def instrument(f):
             if not hasattr(obj, '_instruments'):
                 obj._instruments = {}
             obj._instruments[f.__name__] = (end - start) * 1000
+            if hasattr(obj, 'latency'):
+                obj.latency.record(f.__name__, (end - start) * 1000)
+            tracing.record(f.__name__, start, end, f.__module__)
             return ret
         return instrument
 
@@ -217,6 +328,24 @@ class Frame(object):
         self.process = process
         self.settings = settings
 
+        # Lock-step mode: frames tick together through a shared barrier (see go)
+        self.phases = 0
+        self.lockstep = bool(settings and settings["General"].get("LockStep", False))
+        self.barrier = None
+        # True if the store pushes changes to this frame (see process_declarations)
+        self.subscribed = False
+        # Pipelined mode: store I/O runs on a background worker while the
+        # application updates (see execute_pipelined)
+        self.pipelined = bool(settings and settings["General"].get("Pipelined", False))
+        if self.pipelined and self.lockstep:
+            logger.warn("%s Pipelined is ignored in lock-step mode", LOG_HEADER)
+            self.pipelined = False
+        self.io = None
+        # Writes of the last tick, sent by the I/O worker during the next one
+        self.outgoing = None
+        # Latency histograms of the instrumented phases and of the ticks
+        self.latency = Histograms()
+
         # Local storage for thread
         self.tlocal = None
 
@@ -250,7 +379,14 @@ class Frame(object):
         # List of objects marked for deletion
         self.deletelist = {}
 
-        # Holds a k,v storage of foreign keys (e.g. name -> id)
+        # Inserts, deletes and updates waiting for the next sync with the store
+        self.staged = None
+
+        # Store version of the objects last pulled: { type : { primary_key : version } }
+        self.versions = {}
+
+        # Indexes of the properties foreign keys point to, kept up to date
+        # by pull, add and delete: { type : { property_name : { value : primary_key } } }
         self.fkdict = {}
 
         # Disables fetching of subsets
@@ -279,6 +415,8 @@ class Frame(object):
             obj._frame = self
             self.newlyproduced[t][obj._primarykey] = obj
             self.storebuffer[t][obj._primarykey] = obj
+            if t in self.fkdict:
+                self._fkobj(obj)
             # If we removed then readded in the same tick, make sure we don't send the remove anymore
             if t in self.deletelist and obj._primarykey in self.deletelist[t]:
                 del self.deletelist[t][obj._primarykey]
@@ -290,6 +428,8 @@ class Frame(object):
             o = self.storebuffer[t][oid]
             self.deletelist[t][o._primarykey] = o
             del self.storebuffer[t][oid]
+            if t in self.fkdict:
+                self._delfkobj(o)
             # If we added and removed in the same tick, make sure we don't send the add
             if t in self.newlyproduced and o._primarykey in self.newlyproduced[t]:
                 del self.newlyproduced[t][o._primarykey]
@@ -342,9 +482,14 @@ class Frame(object):
         self.process_declarations(app)
         #self.app.initialize()
 
-    def go(self, cmd_dict, timer=None):
+    def go(self, cmd_dict, timer=None, barrier=None):
+        '''
+        Starts the frame's TimerThread. In lock-step mode, barrier is the
+        TickBarrier shared by all frames of the simulation.
+        '''
         self.cmds = cmd_dict
         self.timer = timer
+        self.barrier = barrier
         self.runner = TimerThread(self, Frame.Store, cmd_dict, timer)
         if self.process:
             self.thread = Process(target=self.runner.run)
@@ -359,22 +504,133 @@ class Frame(object):
     ## Core Functions
     ######################################################
     def execute_Frame(self):
+        if self.pipelined:
+            return self.execute_pipelined()
+        # Barrier phases of this tick the frame has not gone through yet
+        self.phases = 2 if self.barrier else 0
         try:
             self.pull()
+            # Nobody pushes this tick before everyone pulled
+            if not self.meet():
+                return
             self.track_changes = True
-            self.app.update()
+            with tracing.span("update", self.app.__module__):
+                self.app.update()
             self.track_changes = False
             self.push()
+            if self.barrier and self.staged:
+                # Writes must reach the store this tick, not with the next pull
+                self.flush()
+            # Nobody pulls the next tick before everyone pushed
+            if not self.meet():
+                return
             self.step += 1
             self.curtime = time.time()
         except:
             self.cmds["SimulatorPaused"] = True
             logger.exception("[%s] uncaught exception: ", self.app.__module__)
+            # The other frames are waiting for this one at the phases it did
+            # not reach. Until one of them sees the pause and aborts, go
+            # through the phases so they all end the tick together.
+            while self.phases and self.meet():
+                pass
+
+    def meet(self):
+        '''
+        Waits at the tick barrier for the other frames to reach the next
+        phase of the tick. Returns False if the wait was aborted because the
+        simulation paused or is shutting down.
+        '''
+        if not self.phases:
+            return True
+        self.phases -= 1
+        return self.barrier.wait(self.barrier_aborted)
+
+    def execute_pipelined(self):
+        '''
+        Tick with the store I/O overlapping the application's update: the
+        I/O worker sends the writes of tick N-1 and then fetches updates
+        while tick N updates. Compared with execute_Frame:
+        - writes reach the store one tick later, in tick order
+        - a tick applies the updates fetched during the previous tick, which
+          include the frame's writes up to two ticks back
+        - the buffers are only touched by the frame's thread: the worker
+          gets the staged writes and returns what the store answered
+        '''
+        try:
+            if self.io is None:
+                # Created here, in the thread or process running the frame
+                self.io = IOWorker("io-%s" % self.app._appname)
+                updates = self.fetch()
+            else:
+                updates = self.prefetched()
+            self.apply_fetched(updates)
+            self.io.submit(self.exchange, self.outgoing, getattr(tracing.current, "tick", None))
+            self.outgoing = None
+
+            self.track_changes = True
+            with tracing.span("update", self.app.__module__):
+                self.app.update()
+            self.track_changes = False
+            self.stage_push()
+            (inserts, deletes, updates) = self.staged
+            self.staged = None
+            # The application may change its new objects while they are sent
+            self.outgoing = (deepcopy(inserts), deletes, updates)
+            self.step += 1
+            self.curtime = time.time()
+        except:
+            self.cmds["SimulatorPaused"] = True
+            logger.exception("[%s] uncaught exception: ", self.app.__module__)
+
+    @instrument
+    def prefetched(self):
+        # Time spent here is store I/O the update did not hide
+        return self.io.result()
+
+    @tracing.traced()
+    def exchange(self, outgoing, tick=None):
+        # Runs on the I/O worker, for the frame's tick
+        tracing.set_tick(tick)
+        observed = [(t, t in self.tracked_only) for t in self.iterate_types if t not in self.subset_disable]
+        if hasattr(Frame.Store, "sync"):
+            (inserts, deletes, updates) = outgoing or ({}, {}, {})
+            with self.pinned():
+                return self.sync(inserts, deletes, updates, observed)
+        if outgoing:
+            self.send(outgoing)
+        return self.fetch()
+
+    @contextmanager
+    def pinned(self):
+        '''
+        Reads made in the block see the same committed store version, for
+        the stores keeping versions (see SimpleStore.pin). The version is
+        released after the block, so it does not hold back reclaim.
+        '''
+        if not hasattr(Frame.Store, "pin"):
+            yield
+            return
+        Frame.Store.pin(self.app._appname)
+        try:
+            yield
+        finally:
+            Frame.Store.unpin(self.app._appname)
+
+    def shutting_down(self):
+        return self.cmds["SimulatorShutdown"]
+
+    def barrier_aborted(self):
+        # A paused frame does not tick until it is resumed, so waiting for it
+        # would block the other frames
+        return self.cmds["SimulatorShutdown"] or self.cmds["SimulatorPaused"]
 
     def initialize_app(self):
         self.app.initialize()
         # Push initial objects the application has added.
         self.push()
+        if self.staged:
+            self.flush()
         self._update_shared_status("Pushed")
         logger.warn("Application %s finished pushing", self.app._appname)
         it = 0
@@ -416,6 +672,7 @@ class Frame(object):
             self.new_storebuffer[t] = {}
             self.mod_storebuffer[t] = {}
             self.del_storebuffer[t] = {}
+            self.versions[t] = {}
             if hasattr(t, "_foreignkeys"):
                 for propname, cls in t._foreignkeys.items():
                     fname = getattr(t, propname)._foreignprop._name
@@ -455,16 +712,41 @@ class Frame(object):
                 Frame.Store = SimpleStore()
         setattr(self.app, "_appname", self.app.__class__.__name__)
         Frame.Store.register(self.app._appname)
+        if hasattr(Frame.Store, "subscribe") and not self.lockstep:
+            # Have the store push changes for every observed type. Not in
+            # lock-step mode, where changes must be read the tick they are made
+            self.subscribed = True
+            Frame.Store.subscribe(self.app._appname, [(t, t in self.tracked_only) for t in self.iterate_types], deltas=True)
 
     def stop(self):
+        if self.io:
+            # Let the worker finish, then send the last tick's writes
+            if self.io.pending:
+                self.io.result()
+            if self.outgoing:
+                self.send(self.outgoing)
+                self.outgoing = None
         self.app.shutdown()
+        if self.staged:
+            # Writes of the last tick, waiting for a sync that will not come
+            self.flush()
+        # Stops the store's own threads, such as a subscription listener
+        Frame.Store.close()
 
     ######################################################
     ## Frame -> Store Functions
     ######################################################
     @instrument
     def pull(self):
+        # optimization: retrieve only objects that changed since last pull
+        if hasattr(Frame.Store, "sync") or hasattr(Frame.Store, "getupdated"):
+            self.apply_fetched(self.fetch())
+            return
+
         tmpbuffer = {}
+        if hasattr(Frame.Store, "pin"):
+            # Read every type at the same committed store version
+            Frame.Store.pin(self.app._appname)
         for t in self.iterate_types:
             if t in self.subset_disable:
                 continue
@@ -473,125 +755,282 @@ class Frame(object):
             self.mod_storebuffer[t] = {}
             self.del_storebuffer[t] = {}
 
-            # optimization: retrieve only objects that changed since last pull
-            if hasattr(Frame.Store, "getupdated"):
-                if t in self.tracked_only:
-                    (new, mod, deleted) = Frame.Store.getupdated(t, self.app._appname, tracked_only=True)
-                else:
-                    (new, mod, deleted) = Frame.Store.getupdated(t, self.app._appname)
-                if t in schema_subsets:
-                    # Parent type of subset 't'
-                    pt = setsof[t]
-
-                    # Iterate for orphan keys from last pull
-                    notfound = set()
-                    for key in self.orphan_objids[t]:
-                        if key in self.storebuffer[pt]:
-                            o = copy(self.storebuffer[pt][key])
-                            o.__class__ = t
-                            self.storebuffer[t][key] = o
-                            self.new_storebuffer[t][key] = o
-                        else:
-                            notfound.add(key)
-                            self.__Logger.error("missing key %s for new object in subset list", key)
-                    self.orphan_objids[t] = set().union(notfound)
-
-                    for key in new:
-                        # If the key is not in the store's buffer, its likely the object was created between
-                        # the get for parent type and the current subset query. This is expected, just keep a reference
-                        # to check for again on next pull.
-                        if key in self.storebuffer[pt]:
-                            o = copy(self.storebuffer[pt][key])
-                            o.__class__ = t
-                            self.storebuffer[t][key] = o
-                            self.new_storebuffer[t][key] = o
-                        else:
-                            self.orphan_objids[t].add(key)
-                    for key in mod:
-                        o = copy(self.storebuffer[pt][key])
-                        o.__class__ = t
-                        self.storebuffer[t][key] = o
-                        self.mod_storebuffer[t][key] = o
-                    for key in deleted:
-                        if key in self.storebuffer[pt]:
-                            o = copy(self.storebuffer[pt][key])
-                        elif key in self.del_storebuffer[pt]:
-                            o = copy(self.del_storebuffer[pt][key])
-                        else:
-                            self.__Logger.warn("object %s was deleted, could find find a reference to give to application.", key)
-                            o = CADIS()
-                            o.ID = key
-                        o.__class__ = t
-                        del self.storebuffer[t][key]
-                        self.del_storebuffer[t][key] = o
+            tmpbuffer[t] = {}
+            for o in Frame.Store.get(t):
+                tmpbuffer[t][o._primarykey] = o
+
+            # TODO: Remove when Store does this
+            # Added objects since last pull
+            versions = self.versions[t]
+            for o in tmpbuffer[t].values():
+                if o._primarykey not in self.storebuffer[t]:
+                    # logger.debug("%s Found new object: %s", LOG_HEADER, o)
+                    self.new_storebuffer[t][o._primarykey] = o
+                elif hasattr(o, "_version"):
+                    # check if updated
+                    if versions.get(o._primarykey) != o._version:
+                        self.mod_storebuffer[t][o._primarykey] = o
                 else:
-                    for o in new:
-                        self.storebuffer[t][o._primarykey] = o
-                        self.new_storebuffer[t][o._primarykey] = o
-                        if o.__class__ in self.fkdict:
-                            self._fkobj(o)
-                    for o in mod:
-                        self.storebuffer[t][o._primarykey] = o
+                    # Store without versions: compare the objects
+                    orig = self.encoder.encode(self.storebuffer[t][o._primarykey])
+                    new = self.encoder.encode(o)
+                    if orig != new:
                         self.mod_storebuffer[t][o._primarykey] = o
-                        if o.__class__ in self.fkdict:
-                            self._fkobj(o)
-                    for key in deleted:
-                        if key in self.storebuffer[t]:
-                            o = self.storebuffer[t][key]
-                            self.del_storebuffer[t][key] = o
-                            del self.storebuffer[t][key]
-                        if o.__class__ in self.fkdict:
-                            self._delfkobj(o)
+                versions[o._primarykey] = getattr(o, "_version", None)
 
-            else:
-                tmpbuffer[t] = {}
-                for o in Frame.Store.get(t):
-                    tmpbuffer[t][o._primarykey] = o
-
-                # TODO: Remove when Store does this
-                # Added objects since last pull
+            # Deleted objects since last pull
+            for o in self.storebuffer[t].values():
+                if o._primarykey not in tmpbuffer[t]:
+                    self.del_storebuffer[t][o._primarykey] = o
+                    versions.pop(o._primarykey, None)
+
+            self.storebuffer[t] = tmpbuffer[t]
+            if t in self.fkdict:
+                self._reindex(t)
+            if t in subsetsof:
                 for o in tmpbuffer[t].values():
+                    self._realias(t, o)
+        if hasattr(Frame.Store, "unpin"):
+            Frame.Store.unpin(self.app._appname)
+
+    @tracing.traced()
+    def fetch(self):
+        '''
+        Reads the updates of every observed type from the store, as
+        { type : (new, mod, deleted) }. The buffers are not touched, so that
+        the I/O worker of a pipelined frame may run it.
+        '''
+        with self.pinned():
+            return self.read_updates()
+
+    def read_updates(self):
+        types = [t for t in self.iterate_types if t not in self.subset_disable]
+        if hasattr(Frame.Store, "sync"):
+            # One round-trip: send the writes staged by the last push and
+            # fetch the updates for every observed type
+            return self.flush([(t, t in self.tracked_only) for t in types])
+        if self.subscribed:
+            # Collect the changes pushed by the store since the last pull
+            Frame.Store.drain()
+        updates = {}
+        for t in types:
+            with tracing.span("getupdated %s" % t._FULLNAME, "store"):
+                if t in self.tracked_only:
+                    updates[t] = Frame.Store.getupdated(t, self.app._appname, tracked_only=True, deltas=True)
+                else:
+                    updates[t] = Frame.Store.getupdated(t, self.app._appname, deltas=True)
+        return updates
+
+    def apply_fetched(self, updates):
+        for t in self.iterate_types:
+            if t in self.subset_disable:
+                continue
+            self.new_storebuffer[t] = {}
+            self.mod_storebuffer[t] = {}
+            self.del_storebuffer[t] = {}
+            (new, mod, deleted) = updates[t]
+            self.apply_updates(t, new, mod, deleted)
+
+    def refetch(self, t, key):
+        '''
+        Reads the whole object for a Delta of an object the frame does not
+        have, and buffers it as new to the application.
+        '''
+        self.__Logger.warn("update of unknown object %s of type %s, reading the whole object", key, t._FULLNAME)
+        o = Frame.Store.getobj(t, key) if hasattr(Frame.Store, "getobj") else None
+        if o is None:
+            self.__Logger.error("could not read object %s of type %s", key, t._FULLNAME)
+            return
+        self.storebuffer[t][key] = o
+        self.new_storebuffer[t][key] = o
+        self.versions[t][key] = getattr(o, "_version", None)
+        if o.__class__ in self.fkdict:
+            self._fkobj(o)
+
+    def apply_updates(self, t, new, mod, deleted):
+        '''
+        Merges the changes retrieved from the store for type t into the
+        buffers. For subsets, new, mod and deleted are lists of primary keys.
+        Updated objects may be Deltas, applied to the buffered objects.
+        '''
+        if t in schema_subsets:
+            # Parent type of subset 't'
+            pt = setsof[t]
+
+            # Iterate for orphan keys from last pull
+            notfound = set()
+            for key in self.orphan_objids[t]:
+                if key in self.storebuffer[pt]:
+                    o = self._subsetview(t, self.storebuffer[pt][key])
+                    self.storebuffer[t][key] = o
+                    self.new_storebuffer[t][key] = o
+                else:
+                    notfound.add(key)
+                    self.__Logger.error("missing key %s for new object in subset list", key)
+            self.orphan_objids[t] = set().union(notfound)
+
+            for key in new:
+                # If the key is not in the store's buffer, its likely the object was created between
+                # the get for parent type and the current subset query. This is expected, just keep a reference
+                # to check for again on next pull.
+                if key in self.storebuffer[pt]:
+                    o = self._subsetview(t, self.storebuffer[pt][key])
+                    self.storebuffer[t][key] = o
+                    self.new_storebuffer[t][key] = o
+                else:
+                    self.orphan_objids[t].add(key)
+            for key in mod:
+                o = self._subsetview(t, self.storebuffer[pt][key], self.storebuffer[t].get(key))
+                self.storebuffer[t][key] = o
+                self.mod_storebuffer[t][key] = o
+            for key in deleted:
+                if key in self.storebuffer[t]:
+                    o = self.storebuffer[t][key]
+                elif key in self.storebuffer[pt]:
+                    o = self._subsetview(t, self.storebuffer[pt][key])
+                elif key in self.del_storebuffer[pt]:
+                    o = self._subsetview(t, self.del_storebuffer[pt][key])
+                else:
+                    self.__Logger.warn("object %s was deleted, could find find a reference to give to application.", key)
+                    o = CADIS()
+                    o.ID = key
+                    o.__class__ = t
+                del self.storebuffer[t][key]
+                self.del_storebuffer[t][key] = o
+        else:
+            versions = self.versions[t]
+            for o in new:
+                self.storebuffer[t][o._primarykey] = o
+                self.new_storebuffer[t][o._primarykey] = o
+                versions[o._primarykey] = getattr(o, "_version", None)
+                if o.__class__ in self.fkdict:
+                    self._fkobj(o)
+            for o in mod:
+                version = getattr(o, "_version", None)
+                if version is not None and versions.get(o._primarykey) == version:
+                    # Already seen this version of the object
+                    continue
+                if isinstance(o, Delta):
                     if o._primarykey not in self.storebuffer[t]:
-                        # logger.debug("%s Found new object: %s", LOG_HEADER, o)
-                        self.new_storebuffer[t][o._primarykey] = o
-                    else:
-                        # check if updated
-                        orig = self.encoder.encode(self.storebuffer[t][o._primarykey])
-                        new = self.encoder.encode(o)
-                        if orig != new:
-                            self.mod_storebuffer[t][o._primarykey] = o
-
-                # Deleted objects since last pull
-                for o in self.storebuffer[t].values():
-                    if o._primarykey not in tmpbuffer[t]:
-                        self.del_storebuffer[t][o._primarykey] = o
-
-                self.storebuffer[t] = tmpbuffer[t]
+                        self.refetch(t, o._primarykey)
+                        continue
+                    # A new object, so that the application sees the same as
+                    # when the whole object is sent
+                    o = o.apply(self.storebuffer[t][o._primarykey])
+                versions[o._primarykey] = version
+                if o.__class__ in self.fkdict and o._primarykey in self.storebuffer[t]:
+                    # The indexed values may have changed
+                    self._delfkobj(self.storebuffer[t][o._primarykey])
+                self.storebuffer[t][o._primarykey] = o
+                self.mod_storebuffer[t][o._primarykey] = o
+                if t in subsetsof:
+                    self._realias(t, o)
+                if o.__class__ in self.fkdict:
+                    self._fkobj(o)
+            for key in deleted:
+                versions.pop(key, None)
+                if key in self.storebuffer[t]:
+                    o = self.storebuffer[t][key]
+                    self.del_storebuffer[t][key] = o
+                    del self.storebuffer[t][key]
+                    if o.__class__ in self.fkdict:
+                        self._delfkobj(o)
 
     @instrument
     def push(self):
+        if hasattr(Frame.Store, "sync"):
+            # Writes are sent along with the next pull, in a single request
+            self.stage_push()
+            return
+        self.stage_push()
+        staged = self.staged
+        self.staged = None
+        self.send(staged)
+
+    @tracing.traced()
+    def send(self, staged):
+        (inserts, deletes, updates) = staged
+        if hasattr(Frame.Store, "commit"):
+            # The whole push is committed as one store version, or rejected
+            # as a whole if an insert is bad (see SimpleStore.commit)
+            try:
+                Frame.Store.commit(self.app._appname, inserts, deletes, updates, check=True)
+            except ValueError, e:
+                logger.error("[%s] push rejected: %s", self.app._appname, e)
+            return
+
+        # At most one call per type for each kind of change, however many
+        # objects changed
+        for t in inserts:
+            if len(inserts[t]) > 0:
+                try:
+                    Frame.Store.insert_all(t, inserts[t], self.app._appname)
+                except ValueError, e:
+                    # None of the list was inserted (see IStore.insert_all)
+                    logger.error("[%s] inserts of %s rejected: %s", self.app._appname, t._FULLNAME, e)
+
+        for t in deletes:
+            if len(deletes[t]) > 0:
+                Frame.Store.delete_all(t, deletes[t], self.app._appname)
+
+        Frame.Store.update_all(updates, self.app._appname)
+
+    def stage_push(self):
+        # A previous batch that was never flushed must reach the store first
+        if self.staged:
+            self.flush()
+
+        inserts = {}
+        deletes = {}
+        updates = {}
         cleartypes = set()
         for t in self.newlyproduced:
             if len(self.newlyproduced[t]) > 0:
-                if hasattr(Frame.Store, "insert_all"):
-                    Frame.Store.insert_all(t, self.newlyproduced[t].values(), self.app._appname)
-                else:
-                    for o in self.newlyproduced[t].values():
-                        Frame.Store.insert(o, self.app._appname)
+                inserts[t] = self.newlyproduced[t].values()
             if t not in self.observed:
                 cleartypes.add(t)
             self.newlyproduced[t] = {}
 
         for t in self.deletelist:
+            deletes[t] = []
             for o in self.deletelist[t].values():
-                Frame.Store.delete(t, o._primarykey, self.app._appname)
+                deletes[t].append(o._primarykey)
                 if t in self.pushlist and o._primarykey in self.pushlist[t]:
                     del self.pushlist[t][o._primarykey]
             self.deletelist[t] = {}
 
-        Frame.Store.update_all(self.pushlist, self.app._appname)
+        for t in self.pushlist:
+            updates[t] = self.pushlist[t]
+            self.pushlist[t] = {}
+
         for t in cleartypes:
             self.storebuffer[t] = {}
+        self.staged = (inserts, deletes, updates)
+
+    @tracing.traced("sync")
+    def flush(self, observed=None):
+        '''
+        Sends the staged writes to a store supporting sync and returns the
+        updates for the observed types: { type : (new, mod, deleted) }
+        '''
+        if self.staged:
+            (inserts, deletes, updates) = self.staged
+        else:
+            (inserts, deletes, updates) = ({}, {}, {})
+        self.staged = None
+        return self.sync(inserts, deletes, updates, observed or [])
+
+    def sync(self, inserts, deletes, updates, observed):
+        '''
+        Store.sync for the frame's simulator. A push the store rejects is
+        logged like the other push errors, and the updates are read anyway.
+        '''
+        try:
+            return Frame.Store.sync(self.app._appname, inserts, deletes, updates, observed, deltas=True)
+        except ValueError, e:
+            # Nothing was written or read
+            logger.error("[%s] push rejected: %s", self.app._appname, e)
+            return Frame.Store.sync(self.app._appname, {}, {}, {}, observed, deltas=True)
 
     ######################################################
     ## Utility Functions
@@ -606,6 +1045,20 @@ class Frame(object):
                     size += sys.getsizeof(prop)
         return (nobjects, size)
 
+    def _subsetview(self, t, parent, view=None):
+        # Member of subset t sharing the attributes of its parent object:
+        # no copy is made, and writes through either land on both
+        if view is None:
+            view = t.__new__(t)
+        view.__dict__ = parent.__dict__
+        return view
+
+    def _realias(self, pt, parent):
+        # The parent object was replaced: point its subset members to it
+        for t in subsetsof[pt]:
+            if t in self.storebuffer and parent._primarykey in self.storebuffer[t]:
+                self._subsetview(t, parent, self.storebuffer[t][parent._primarykey])
+
     def _fkobj(self, o):
         for propname in self.fkdict[o.__class__].keys():
             propvalue = getattr(o, propname)
@@ -614,9 +1067,16 @@ class Frame(object):
     def _delfkobj(self, o):
         for propname in self.fkdict[o.__class__].keys():
             propvalue = getattr(o, propname)
-            if propvalue in self.fkdict[o.__class__][propname]:
+            # Only if it still points to this object
+            if self.fkdict[o.__class__][propname].get(propvalue) == o.ID:
                 del self.fkdict[o.__class__][propname][propvalue]
 
+    def _reindex(self, t):
+        for propname in self.fkdict[t]:
+            self.fkdict[t][propname] = {}
+        for o in self.storebuffer[t].values():
+            self._fkobj(o)
+
     def name2class(self, typeName):
         for t in self.storebuffer:
             if t.__name__ == typeName:
@@ -631,6 +1091,10 @@ class Frame(object):
     def _update_shared_status(self, newstatus):
         self.cmds["APP_" + self.app._appname] = newstatus
 
+    def publish_latency(self):
+        # Read by the controller's latency command
+        self.cmds["LATENCY_" + self.app._appname] = self.latency.summary()
+
     def _get_all_shared_statuses(self):
         res = {}
         for k,v in self.cmds.items():
@@ -639,8 +1103,16 @@ class Frame(object):
         return res
 
     def findproperty(self, t, propname, value):
+        if t in self.fkdict and propname in self.fkdict[t]:
+            primkey = self.fkdict[t][propname].get(value)
+            o = self.storebuffer[t].get(primkey)
+            # The application may have changed the property since it was indexed
+            if o is not None and getattr(o, propname) == value:
+                return o
         for o in self.storebuffer[t].values():
             if getattr(o, propname) == value:
+                if t in self.fkdict and propname in self.fkdict[t]:
+                    self.fkdict[t][propname][value] = o._primarykey
                 return o
         return None
 
@@ -674,22 +1146,14 @@ class Frame(object):
         for propname, cls in t._foreignkeys.items():
             propvalue = getattr(obj, propname)
             fname = getattr(t, propname)._foreignprop._name
-            if propvalue in self.fkdict[cls][fname]:
-                primkey = self.fkdict[cls][fname][propvalue]
-            else:
+            if propvalue not in self.fkdict[cls][fname]:
                 # logger.error("Could not find property value in foreign key dictionary.")
                 return None
-            if primkey in self.storebuffer[cls]:
-                newobj = self.storebuffer[cls][primkey]
+            newobj = self.findproperty(cls, fname, propvalue)
+            if newobj is not None:
                 if hasattr(cls, '_foreignkeys'):
                     self._resolve_fk(newobj, cls)
                 setattr(obj, propname, newobj)
-            # Look up by name, just in case
-            else:
-                fname = getattr(obj.__class__, propname)._foreignprop._name
-                for o in self.storebuffer[cls].values():
-                    if propvalue == getattr(o, fname):
-                        setattr(obj, propname, o)
 
 
 
@@ -4,6 +4,7 @@ Created on Feb 19, 2016
 
 author: arthurvaladares
 '''
+import argparse
 from functools import wraps
 from flask import Flask, request
 from flask.helpers import make_response
@@ -29,8 +30,12 @@ sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
 
 from mobdat.simulator.DataModel import Vehicle
 from cadis.common import util
+from cadis.common import tracing
 from cadis.common.util import Instrument
+from cadis.common.IStore import Delta
+from cadis.common.wsgiserver import PooledWSGIServer
 from cadis.language.schema import CADISEncoder, CADIS
+from cadis.language.codec import CODECS, JSONCodec, content_codec
 from cadis.store.simplestore import SimpleStore, InstrumentedSimpleStore
 from mobdat.common.ValueTypes import Vector3
 from mobdat.simulator.DataModel import *
@@ -58,7 +63,7 @@ api = Api(app)
 
 def signal_handler(signal, frame):
     print('You pressed Ctrl+C!')
-    server.shutdown()
+    # Leaves serve_forever, the server shuts down on the way out
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -66,14 +71,88 @@ signal.signal(signal.SIGINT, signal_handler)
 def handle_exceptions(f):
     @wraps(f)
     def wrapped(*args, **kwds):
+        if tracing.tracer is not None:
+            # Spans of the request carry the tick of the simulator that made it
+            tracing.set_tick(request.headers.get('X-CADIS-Tick', None, type=int))
+            start = time.time()
         try:
             ret = f(*args, **kwds)
         except Exception, e:
             logger.exception("Exception handling function %s:", f.func_name)
             raise
+        finally:
+            if tracing.tracer is not None:
+                tracing.record("%s.%s" % (args[0].__class__.__name__, f.func_name), start, time.time(), "request",
+                               {"sim" : kwds.get("sim")})
         return ret
     return wrapped
 
+def sim_codec(sim):
+    return FrameServer.codecs.get(sim, FrameServer.codec_instances[JSONCodec.name])
+
+def respond(sim, ret):
+    # Encoded right away with the simulator's codec
+    codec = sim_codec(sim)
+    return make_response(codec.dumps(ret), 200, {'Content-Type' : codec.content_type})
+
+class EncodedCache(object):
+    '''
+    Encoded objects, per codec, at the latest version read. Simulators
+    reading the same object version get the same bytes, so an object is
+    encoded once per change rather than once per reader.
+    '''
+    def __init__(self):
+        # (codec name, class, primary key) -> (version, Encoded)
+        self.entries = {}
+
+    def encode(self, codec, objs):
+        # Keys (subsets) and objects without a version are left as they are
+        res = []
+        for obj in objs:
+            version = getattr(obj, "_version", None)
+            if version is None:
+                res.append(obj)
+                continue
+            key = (codec.name, obj.__class__, obj._primarykey)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                res.append(entry[1])
+                continue
+            encoded = codec.encode(obj)
+            if entry is None or entry[0] < version:
+                self.entries[key] = (version, encoded)
+            res.append(encoded)
+        return res
+
+    def discard(self, t, keys):
+        for primkey in keys:
+            for name in CODECS:
+                self.entries.pop((name, t, primkey), None)
+
+def encode_updates(sim, typeObj, new, updated, deleted):
+    # { "new" : [ obj ], "updated" : [ obj ], "deleted" : [ primary_key ] },
+    # and "deltas" : [ (primary_key, version, { property_name : value }) ]
+    # for the updated objects sent as Deltas
+    codec = sim_codec(sim)
+    FrameServer.encoded.discard(typeObj, deleted)
+    objs = [o for o in updated if not isinstance(o, Delta)]
+    ret = {"new" : FrameServer.encoded.encode(codec, new),
+           "updated" : FrameServer.encoded.encode(codec, objs),
+           "deleted" : deleted}
+    if len(objs) < len(updated):
+        ret["deltas"] = [(codec.encode_key(d._primarykey), d._version, d.props) for d in updated if isinstance(d, Delta)]
+    return ret
+
+def wants_deltas():
+    return request.args.get('deltas', 0, type=int) == 1
+
+def request_codec():
+    # Codec of the request body, or None for the legacy form-encoded JSON
+    codec = content_codec(request.mimetype)
+    if codec and codec.name != JSONCodec.name:
+        return FrameServer.codec_instances[codec.name]
+    return None
+
 def create_obj(typeObj, data):
     # obj = typeObj.__new__()
     obj = CADIS()
@@ -92,23 +171,23 @@ class GetUpdated(Resource):
     @handle_exceptions
     def get(self, sim, t):
         typeObj = FrameServer.name2class[t]
-        (new, updated, deleted) = FrameServer.Store.getupdated(typeObj, sim, copy_objs=False)
-        ret = {}
-        ret["new"] = new
-        ret["updated"] = updated
-        ret["deleted"] = deleted
-        return ret
+        FrameServer.Store.pin(sim)
+        try:
+            (new, updated, deleted) = FrameServer.Store.getupdated(typeObj, sim, copy_objs=False, deltas=wants_deltas())
+        finally:
+            FrameServer.Store.unpin(sim)
+        return respond(sim, encode_updates(sim, typeObj, new, updated, deleted))
 
 class GetTracked(Resource):
     @handle_exceptions
     def get(self, sim, t):
         typeObj = FrameServer.name2class[t]
-        (new, updated, deleted) = FrameServer.Store.getupdated(typeObj, sim, copy_objs=False, tracked_only=True)
-        ret = {}
-        ret["new"] = new
-        ret["updated"] = updated
-        ret["deleted"] = deleted
-        return ret
+        FrameServer.Store.pin(sim)
+        try:
+            (new, updated, deleted) = FrameServer.Store.getupdated(typeObj, sim, copy_objs=False, tracked_only=True, deltas=wants_deltas())
+        finally:
+            FrameServer.Store.unpin(sim)
+        return respond(sim, encode_updates(sim, typeObj, new, updated, deleted))
 
 
 class GetPushType(Resource):
@@ -120,16 +199,28 @@ class GetPushType(Resource):
 
     @handle_exceptions
     def put(self, sim, t):
+        # Decoded before anything is written, then inserted as one version:
+        # all or nothing
         typeObj = FrameServer.name2class[t]
-        list_objs = json.loads(request.form["insert_list"])
-        for o in list_objs:
-            obj = create_obj(typeObj, o)
-            FrameServer.Store.insert(obj, sim)
+        codec = request_codec()
+        if codec:
+            objs = codec.loads(request.data)
+        else:
+            objs = [create_obj(typeObj, o) for o in json.loads(request.form["insert_list"])]
+        try:
+            FrameServer.Store.insert_all(typeObj, objs, sim)
+        except ValueError, e:
+            # Rejected as a whole, nothing was inserted
+            return {"error" : str(e)}, 400
         return {}
 
     @handle_exceptions
     def post(self, sim, t):
         typeObj = FrameServer.name2class[t]
+        codec = request_codec()
+        if codec:
+            FrameServer.Store.update(typeObj, codec.loads(request.data), sim)
+            return {}
         args = parser.parse_args()
         # update dict is a dictionary of dictionaries: { primary_key : { property_name : property_value } }
         update_dict = json.loads(args["update_dict"])
@@ -137,12 +228,25 @@ class GetPushType(Resource):
         FrameServer.Store.update(typeObj, fixed_dict, sim)
         return {}
 
+    @handle_exceptions
+    def delete(self, sim, t):
+        # [ primary_key ], deleted as one version
+        typeObj = FrameServer.name2class[t]
+        codec = request_codec() or FrameServer.codec_instances[JSONCodec.name]
+        keys = [codec.decode_key(k) for k in codec.loads(request.data)]
+        FrameServer.Store.delete_all(typeObj, keys, sim)
+        return {}
+
 class GetInsertDeleteObject(Resource):
     @handle_exceptions
     def get(self, sim, t, uid):
+        # The whole object, for a simulator that got a Delta of an object it
+        # does not have
         typeObj = FrameServer.name2class[t]
-        obj = FrameServer.Store.get(typeObj, UUID(uid))
-        return obj
+        obj = FrameServer.Store.getobj(typeObj, UUID(uid))
+        if obj is None:
+            return {"error" : "no object %s of type %s" % (uid, t)}, 404
+        return respond(sim, FrameServer.encoded.encode(sim_codec(sim), [obj]))
 
     @handle_exceptions
     def put(self, sim, t, uid):
@@ -158,10 +262,93 @@ class GetInsertDeleteObject(Resource):
         typeObj = FrameServer.name2class[t]
         FrameServer.Store.delete(typeObj, UUID(uid), sim)
 
+class Sync(Resource):
+    @handle_exceptions
+    def post(self, sim):
+        # Applies a whole tick from a simulator and returns its updates:
+        # { "insert" : { type : [ obj ] }, "delete" : { type : [ primary_key ] },
+        #   "update" : { type : { primary_key : { property_name : property_value } } },
+        #   "observe" : [ (type, tracked_only) ], "deltas" : send Deltas }
+        codec = request_codec() or FrameServer.codec_instances[JSONCodec.name]
+        msg = codec.loads(request.data)
+        inserts = {}
+        deletes = {}
+        updates = {}
+        for t, list_objs in msg["insert"].items():
+            typeObj = FrameServer.name2class[t]
+            inserts[typeObj] = [codec.decode_obj(typeObj, o) for o in list_objs]
+        for t, keys in msg["delete"].items():
+            deletes[FrameServer.name2class[t]] = [codec.decode_key(k) for k in keys]
+        for t, update_dict in msg["update"].items():
+            updates[FrameServer.name2class[t]] = {codec.decode_key(k): v for k, v in update_dict.items()}
+        # The whole tick becomes one store version, or is rejected as a whole
+        # like a bulk insert (see GetPushType.put)
+        try:
+            FrameServer.Store.commit(sim, inserts, deletes, updates, check=True)
+        except ValueError, e:
+            # Nothing was written, and the updates are not read either
+            return {"error" : str(e)}, 400
+
+        observed = [(FrameServer.name2class[t], tracked_only) for t, tracked_only in msg["observe"]]
+        return collect_updates(sim, observed, msg.get("deltas", False))
+
+def collect_updates(sim, types, deltas=False):
+    # { type : { "new" : [ obj ], "updated" : [ obj ], "deleted" : [ primary_key ] } }
+    # All types are read at the same store version
+    FrameServer.Store.pin(sim)
+    ret = {}
+    try:
+        for typeObj, tracked_only in types:
+            (new, updated, deleted) = FrameServer.Store.getupdated(typeObj, sim, copy_objs=False, tracked_only=tracked_only, deltas=deltas)
+            ret[typeObj._FULLNAME] = encode_updates(sim, typeObj, new, updated, deleted)
+    finally:
+        FrameServer.Store.unpin(sim)
+    return respond(sim, ret)
+
+class Subscribe(Resource):
+    @handle_exceptions
+    def put(self, sim):
+        # Body: [ (type, tracked_only) ], the types whose changes are pushed to sim
+        codec = request_codec() or FrameServer.codec_instances[JSONCodec.name]
+        FrameServer.subscriptions[sim] = [(FrameServer.name2class[t], tracked_only) for t, tracked_only in codec.loads(request.data)]
+        return {}
+
+    @handle_exceptions
+    def get(self, sim):
+        # Long-poll: held open until one of the subscribed types changes or
+        # the timeout (seconds) expires, then answers with every type's updates
+        timeout = min(float(request.args.get('timeout', 30)), FrameServer.MaxPollTimeout)
+        types = FrameServer.subscriptions.get(sim)
+        if types is None:
+            return {"error" : "%s is not subscribed, PUT the types to subscribe to first" % sim}, 404
+        FrameServer.Store.wait_for_updates(sim, types, timeout, lambda: sim not in FrameServer.subscriptions)
+        if sim not in FrameServer.subscriptions:
+            return {}
+        return collect_updates(sim, types, wants_deltas())
+
+    @handle_exceptions
+    def delete(self, sim):
+        # Cancels the subscription, answering the long-poll waiting for it
+        FrameServer.subscriptions.pop(sim, None)
+        FrameServer.Store.wake()
+        return {}
+
+class Latency(Resource):
+    @handle_exceptions
+    def get(self):
+        # Latency summaries of the store operations since the server started
+        return FrameServer.Store.latency_summary()
+
 class Register(Resource):
     @handle_exceptions
     def put(self, sim):
         FrameServer.Store.register(sim)
+        # Codec negotiation: use the one asked for if we know it
+        name = request.headers.get('X-CADIS-Codec', JSONCodec.name)
+        if name not in FrameServer.codec_instances:
+            name = JSONCodec.name
+        FrameServer.codecs[sim] = FrameServer.codec_instances[name]
+        return {"codec" : name}
 
 def SetupLoggers() :
     global logger
@@ -190,7 +377,19 @@ class FrameServer(object):
     Store = InstrumentedSimpleStore()
     name2class = Store.name2class
     Shutdown = False
-    def __init__(self, inst=False, profiling=False):
+    # Codec negotiated by each simulator on register
+    codecs = {}
+    codec_instances = {name : cls() for name, cls in CODECS.items()}
+    # Types each simulator subscribed to, as [ (type, tracked_only) ]
+    subscriptions = {}
+    MaxPollTimeout = 60
+    encoded = EncodedCache()
+    def __init__(self, inst=False, profiling=False, port=12000, workers=16, trace=False, socket=None):
+        '''
+        workers: number of requests served concurrently
+        trace: write a trace events timeline (see cadis.common.tracing)
+        socket: path of a Unix domain socket to listen on instead of port
+        '''
         global server
         # ## Test Code
         #         self.Store.register("TestSim")
@@ -201,12 +400,20 @@ class FrameServer(object):
         # ##
         SetupLoggers()
         self.profiling = profiling
+        self.httpd = None
+        self.writer = None
+        if trace:
+            tracing.start("frameserver")
         if inst:
             headers = ['time', 'vehicles']
             headers.extend(FrameServer.Store.instruments.keys())
             self.benchmark = Instrument('frameserver', headers)
             self.benchmark.exec_start = datetime.datetime.now()
-            Thread(target=WriteInstruments, args=(self.benchmark,)).start()
+            # Daemon, so that a server that fails to start still exits;
+            # shutdown joins it for the last rows
+            self.writer = Thread(target=WriteInstruments, args=(self.benchmark,), name="instrument-writer")
+            self.writer.daemon = True
+            self.writer.start()
 
         if profiling:
             if not os.path.exists('stats'):
@@ -222,9 +429,22 @@ class FrameServer(object):
         self.api.add_resource(GetPushType, '/<string:sim>/<string:t>')
         self.api.add_resource(GetUpdated, '/<string:sim>/updated/<string:t>')
         self.api.add_resource(GetTracked, '/<string:sim>/tracked/<string:t>')
+        self.api.add_resource(Sync, '/<string:sim>/sync')
+        self.api.add_resource(Subscribe, '/<string:sim>/subscribe')
         self.api.add_resource(Register, '/<string:sim>')
+        self.api.add_resource(Latency, '/stats/latency')
         server = self
-        self.app.run(port=12000, debug=False)
+        try:
+            # Requests are served by a pool of workers: subscribers keep
+            # long-poll requests open, and the store locks per type
+            if socket:
+                # Connectors on the same host reach it as unix://<socket>
+                self.httpd = PooledWSGIServer('unix://' + socket, 0, self.app, workers)
+            else:
+                self.httpd = PooledWSGIServer('localhost', port, self.app, workers)
+            self.httpd.serve_forever()
+        finally:
+            self.shutdown()
 
     def shutdown(self):
         if self.profiling:
@@ -233,6 +453,12 @@ class FrameServer(object):
             self.profile.create_stats()
             self.profile.dump_stats(os.path.join('stats', "%s_frameserver.ps" % (strtime)))
         FrameServer.Shutdown = True
+        if self.httpd:
+            # Called once serve_forever returned: only the socket is left
+            self.httpd.server_close()
+        if self.writer:
+            self.writer.join(5)
+        tracing.stop()
 
 def WriteInstruments(benchmark):
     while (not FrameServer.Shutdown):
@@ -242,6 +468,13 @@ def WriteInstruments(benchmark):
         instruments['vehicles'] = FrameServer.Store.count(Vehicle)
         benchmark.add_instruments(instruments)
         benchmark.dump_stats()
+    benchmark.close()
 
 if __name__ == "__main__":
-    FrameServer(True, True)
+    cmdparser = argparse.ArgumentParser()
+    cmdparser.add_argument("--port", help="port to listen on", type=int, default=12000)
+    cmdparser.add_argument("--workers", help="number of requests served concurrently", type=int, default=16)
+    cmdparser.add_argument("--trace", help="write a trace events timeline to stats/", action="store_true")
+    cmdparser.add_argument("--socket", help="listen on this Unix domain socket instead of --port")
+    options = cmdparser.parse_args()
+    FrameServer(True, True, options.port, options.workers, options.trace, options.socket)
@@ -0,0 +1,386 @@
+'''
+Wire codecs used between PythonRemoteStore and the frame server.
+
+JSONCodec is the original CADISEncoder based format. BinaryCodec is a
+compact tagged format: CADIS objects are written as a class reference
+followed by their dimensions in a fixed per-type order (no property
+names) and their store version, registered value types such as Vector3 are written as packed
+doubles and UUIDs take 16 bytes.
+
+Both codecs can also splice values encoded beforehand (Encoded, see
+encode) into a message, which lets the frame server encode an object
+version once for all the simulators that read it.
+'''
+
+import json
+import operator
+import struct
+from uuid import UUID
+
+from cadis.language import schema
+from cadis.language.schema import CADIS, CADISEncoder
+
+class Encoded(str):
+    '''
+    A value already encoded by a codec, written as is by its dumps.
+    '''
+    __slots__ = ()
+
+class JSONCodec(object):
+    name = "json"
+    content_type = "application/json"
+
+    def __init__(self):
+        self.encoder = CADISEncoder()
+
+    def dumps(self, msg):
+        if not _has_encoded(msg):
+            return self.encoder.encode(msg)
+        if isinstance(msg, Encoded):
+            return msg
+        if isinstance(msg, dict):
+            return "{%s}" % ", ".join("%s: %s" % (json.dumps(str(k)), self.dumps(v)) for k, v in msg.iteritems())
+        return "[%s]" % ", ".join(self.dumps(v) for v in msg)
+
+    def encode(self, value):
+        return Encoded(self.encoder.encode(value))
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode_key(self, key):
+        return str(key)
+
+    def decode_key(self, key):
+        return UUID(key)
+
+    def decode_obj(self, typeObj, data):
+        obj = typeObj.__new__(typeObj)
+        for dim in obj._dimensions:
+            prop = getattr(obj, dim._name)
+            if hasattr(prop, "__decode__"):
+                prop = prop.__decode__(data[dim._name])
+            else:
+                prop = data[dim._name]
+            setattr(obj, dim._name, prop)
+        obj.ID = UUID(data["ID"])
+        if "_version" in data:
+            obj._version = data["_version"]
+        return obj
+
+    def decode_props(self, typeObj, props):
+        # { property_name : value } of a Delta, decoded as in decode_obj
+        probe = typeObj.__new__(typeObj)
+        res = {}
+        for name, value in props.items():
+            default = getattr(probe, name, None)
+            if hasattr(default, "__decode__"):
+                value = default.__decode__(value)
+            res[name] = value
+        return res
+
+_NONE = 0
+_TRUE = 1
+_FALSE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_UUID = 6
+_LIST = 7
+_DICT = 8
+_OBJ = 9
+_VALUE = 10
+_BIGINT = 11
+_ENCODED = 12
+
+_tag = struct.Struct('<B')
+_int = struct.Struct('<q')
+_float = struct.Struct('<d')
+_len = struct.Struct('<I')
+_ref = struct.Struct('<H')
+_tagint = struct.Struct('<Bq')
+_tagfloat = struct.Struct('<Bd')
+_taglen = struct.Struct('<BI')
+_taguuid = struct.Struct('>BQQ')
+_uuid = struct.Struct('>QQ')
+_LOW64 = (1 << 64) - 1
+
+# Value type -> (fields, struct), e.g. Vector3 -> (('x', 'y', 'z'), '<3d')
+value_types = {}
+
+def register_value_type(cls, fields):
+    '''
+    Value types registered here are sent as fixed-width doubles instead of
+    their __json__ dictionary. fields must follow the order of the
+    constructor arguments, which is used to rebuild the value.
+    '''
+    value_types[cls] = (tuple(fields), struct.Struct('<%dd' % len(fields)))
+
+class Layout(object):
+    '''
+    Precompiled field order of a CADIS type. Each field keeps the decoder
+    of the class default value, mirroring what create_obj does with JSON.
+    '''
+    def __init__(self, cls):
+        self.cls = cls
+        self.fields = []
+        probe = cls.__new__(cls)
+        names = set(dim._name for dim in cls._dimensions)
+        names.add("ID")
+        for name in sorted(names):
+            default = getattr(probe, name, None)
+            self.fields.append((name, getattr(default, "__decode__", None)))
+        self.getter = operator.attrgetter(*[name for name, _ in self.fields])
+        self.decoders = dict(self.fields)
+
+class BinaryCodec(object):
+    name = "binary"
+    content_type = "application/x-cadis-binary"
+
+    def __init__(self):
+        self.layouts = {}
+        self.classes = {}
+        # Class of a value -> function writing it, resolved once per class
+        self.writers = {
+            type(None) : self._write_none,
+            bool : self._write_bool,
+            int : self._write_int,
+            long : self._write_int,
+            float : self._write_float,
+            str : self._write_str,
+            unicode : self._write_str,
+            UUID : self._write_uuid,
+            list : self._write_list,
+            tuple : self._write_list,
+            set : self._write_list,
+            dict : self._write_dict,
+            Encoded : self._write_encoded
+        }
+
+    def dumps(self, msg):
+        out = []
+        self._write(msg, out, {})
+        return ''.join(out)
+
+    def encode(self, value):
+        # Class references are numbered per message: an encoded value
+        # carries its own, and is read back with them (see _ENCODED)
+        return Encoded(self.dumps(value))
+
+    def loads(self, data):
+        value, _ = self._read(data, 0, [])
+        return value
+
+    def encode_key(self, key):
+        return key
+
+    def decode_key(self, key):
+        return key
+
+    def decode_obj(self, typeObj, data):
+        return data
+
+    def decode_props(self, typeObj, props):
+        decoders = self.layout(typeObj).decoders
+        for name, value in props.items():
+            decode = decoders.get(name)
+            if decode and isinstance(value, dict):
+                props[name] = decode(value)
+        return props
+
+    def layout(self, cls):
+        if cls not in self.layouts:
+            self.layouts[cls] = Layout(cls)
+        return self.layouts[cls]
+
+    def lookup(self, name):
+        if name not in self.classes:
+            for cls in schema.dimensions.keys() + value_types.keys():
+                self.classes[_classname(cls)] = cls
+        return self.classes[name]
+
+    def _write_ref(self, cls, out, refs):
+        if cls in refs:
+            out.append(_ref.pack(refs[cls]))
+        else:
+            # First use of a class in this message: define it
+            refs[cls] = len(refs)
+            out.append(_ref.pack(refs[cls]))
+            self._write_str(_classname(cls), out, refs)
+
+    def _write(self, value, out, refs):
+        writer = self.writers.get(value.__class__)
+        if writer is None:
+            writer = self._resolve_writer(value.__class__)
+        writer(value, out, refs)
+
+    def _resolve_writer(self, cls):
+        if issubclass(cls, CADIS):
+            writer = self._write_obj
+        elif cls in value_types:
+            writer = self._write_value
+        elif hasattr(cls, "__json__"):
+            writer = self._write_json
+        else:
+            raise TypeError("%s is not serializable by BinaryCodec" % cls)
+        self.writers[cls] = writer
+        return writer
+
+    def _write_none(self, value, out, refs):
+        out.append(_tag.pack(_NONE))
+
+    def _write_bool(self, value, out, refs):
+        out.append(_tag.pack(_TRUE if value else _FALSE))
+
+    def _write_int(self, value, out, refs):
+        if -2 ** 63 <= value < 2 ** 63:
+            out.append(_tagint.pack(_INT, value))
+        else:
+            out.append(_tag.pack(_BIGINT))
+            self._write_str(str(value), out, refs)
+
+    def _write_float(self, value, out, refs):
+        out.append(_tagfloat.pack(_FLOAT, value))
+
+    def _write_str(self, value, out, refs):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        out.append(_taglen.pack(_STR, len(value)))
+        out.append(value)
+
+    def _write_uuid(self, value, out, refs):
+        i = value.int
+        out.append(_taguuid.pack(_UUID, i >> 64, i & _LOW64))
+
+    def _write_list(self, value, out, refs):
+        out.append(_taglen.pack(_LIST, len(value)))
+        for v in value:
+            self._write(v, out, refs)
+
+    def _write_dict(self, value, out, refs):
+        out.append(_taglen.pack(_DICT, len(value)))
+        for k, v in value.iteritems():
+            self._write(k, out, refs)
+            self._write(v, out, refs)
+
+    def _write_obj(self, value, out, refs):
+        out.append(_tag.pack(_OBJ))
+        self._write_ref(value.__class__, out, refs)
+        write = self._write
+        layout = self.layout(value.__class__)
+        if len(layout.fields) == 1:
+            write(layout.getter(value), out, refs)
+        else:
+            for v in layout.getter(value):
+                write(v, out, refs)
+        write(getattr(value, "_version", None), out, refs)
+
+    def _write_value(self, value, out, refs):
+        fields, packer = value_types[value.__class__]
+        out.append(_tag.pack(_VALUE))
+        self._write_ref(value.__class__, out, refs)
+        out.append(packer.pack(*[getattr(value, f) for f in fields]))
+
+    def _write_json(self, value, out, refs):
+        self._write(value.__json__(), out, refs)
+
+    def _write_encoded(self, value, out, refs):
+        out.append(_taglen.pack(_ENCODED, len(value)))
+        out.append(value)
+
+    def _read_ref(self, data, pos, refs):
+        (idx,) = _ref.unpack_from(data, pos)
+        pos += _ref.size
+        if idx == len(refs):
+            name, pos = self._read(data, pos, refs)
+            refs.append(self.lookup(name))
+        return refs[idx], pos
+
+    def _read(self, data, pos, refs):
+        (tag,) = _tag.unpack_from(data, pos)
+        pos += 1
+        if tag == _NONE:
+            return None, pos
+        elif tag == _TRUE:
+            return True, pos
+        elif tag == _FALSE:
+            return False, pos
+        elif tag == _INT:
+            return _int.unpack_from(data, pos)[0], pos + _int.size
+        elif tag == _FLOAT:
+            return _float.unpack_from(data, pos)[0], pos + _float.size
+        elif tag == _STR:
+            (n,) = _len.unpack_from(data, pos)
+            pos += _len.size
+            return data[pos:pos + n].decode('utf-8'), pos + n
+        elif tag == _UUID:
+            (high, low) = _uuid.unpack_from(data, pos)
+            return UUID(int=(high << 64) | low), pos + _uuid.size
+        elif tag == _LIST:
+            (n,) = _len.unpack_from(data, pos)
+            pos += _len.size
+            res = []
+            for _ in xrange(n):
+                v, pos = self._read(data, pos, refs)
+                res.append(v)
+            return res, pos
+        elif tag == _DICT:
+            (n,) = _len.unpack_from(data, pos)
+            pos += _len.size
+            res = {}
+            for _ in xrange(n):
+                k, pos = self._read(data, pos, refs)
+                v, pos = self._read(data, pos, refs)
+                res[k] = v
+            return res, pos
+        elif tag == _OBJ:
+            cls, pos = self._read_ref(data, pos, refs)
+            obj = cls.__new__(cls)
+            for name, decode in self.layout(cls).fields:
+                v, pos = self._read(data, pos, refs)
+                if decode and isinstance(v, dict):
+                    v = decode(v)
+                setattr(obj, name, v)
+            version, pos = self._read(data, pos, refs)
+            if version is not None:
+                obj._version = version
+            return obj, pos
+        elif tag == _VALUE:
+            cls, pos = self._read_ref(data, pos, refs)
+            _, packer = value_types[cls]
+            return cls(*packer.unpack_from(data, pos)), pos + packer.size
+        elif tag == _BIGINT:
+            v, pos = self._read(data, pos, refs)
+            return long(v), pos
+        elif tag == _ENCODED:
+            (n,) = _len.unpack_from(data, pos)
+            pos += _len.size
+            v, _ = self._read(data, pos, [])
+            return v, pos + n
+        else:
+            raise ValueError("Unknown tag %s in BinaryCodec data" % tag)
+
+def _has_encoded(msg):
+    if isinstance(msg, Encoded):
+        return True
+    if isinstance(msg, dict):
+        return any(_has_encoded(v) for v in msg.itervalues())
+    if isinstance(msg, (list, tuple)):
+        return any(_has_encoded(v) for v in msg)
+    return False
+
+def _classname(cls):
+    if hasattr(cls, "_FULLNAME"):
+        return cls._FULLNAME
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+CODECS = {
+    JSONCodec.name : JSONCodec,
+    BinaryCodec.name : BinaryCodec
+}
+
+def content_codec(content_type):
+    for codec in CODECS.values():
+        if codec.content_type == content_type:
+            return codec
+    return None
@@ -70,7 +70,7 @@ def Set(cls):
 def SubSet(of):
     def wrapped(cls):
         subsets.add(cls)
-        if of in subsets:
+        if of in subsetsof:
             subsetsof[of].append(cls)
         else:
             subsetsof[of] = [cls]
@@ -117,7 +117,7 @@ class Property(property):
                     fname = self._foreignprop._name
                     res = frame.findproperty(self._relatedto, fname, value)
                     if not res:
-                        self.__Logger.error("could not match foreign key %s = %s to existing object of type %s", self._name, value, self._relatedto)
+                        logger.error("could not match foreign key %s = %s to existing object of type %s", self._name, value, self._relatedto)
         property.__set__(self, obj, value)
 
     def __relatedto__(self, relatedto):
@@ -258,6 +258,8 @@ class CADISEncoder(json.JSONEncoder):
                         else:
                             obj_dict[dim._name] = prop
                 obj_dict["ID"] = obj.ID
+                if hasattr(obj, "_version"):
+                    obj_dict["_version"] = obj._version
                 return obj_dict
             except:
                 self.__Logger.debug("Could not convert encode object from Python -> JSON")
@@ -118,9 +118,13 @@ class Car(CADIS):
 
 @SubSet(Car)
 class InactiveCar(Car):
+    @staticmethod
+    def predicate(c):
+        return c.Position == Vector3(0,0,0)
+
     @staticmethod
     def query():
-        return [c for c in Frame.Store.get(Car) if c.Position == Vector3(0,0,0)]  # @UndefinedVariable
+        return [c for c in Frame.Store.get(Car) if InactiveCar.predicate(c)]  # @UndefinedVariable
 
     def start(self):
         logger.debug("[InactiveCar]: {0} starting".format(self.ID))
@@ -128,9 +132,13 @@ class InactiveCar(Car):
 
 @SubSet(Car)
 class ActiveCar(Car):
+    @staticmethod
+    def predicate(c):
+        return c.Velocity != Vector3(0,0,0)
+
     @staticmethod
     def query():  # @DontTrace
-        return [c for c in Frame.Store.get(Car) if c.Velocity != Vector3(0,0,0)]  # @UndefinedVariable
+        return [c for c in Frame.Store.get(Car) if ActiveCar.predicate(c)]  # @UndefinedVariable
     def move(self):
         self.Position = Vector3(self.Position.X + self.Velocity.X, self.Position.Y + self.Velocity.Y, self.Position.Z + self.Velocity.Z)
         logger.debug("[ActiveCar]: Current velocity: {0}, New position {1}".format(self.Velocity, self.Position));
@@ -207,9 +215,13 @@ class Pedestrian(CADIS):
 
 @SubSet(Pedestrian)
 class StoppedPedestrian(Pedestrian):
+    @staticmethod
+    def predicate(p):
+        return p.X == Pedestrian.INITIAL_POSITION
+
     @staticmethod
     def query():
-        return [p for p in Frame.Store.get(Pedestrian) if p.X == Pedestrian.INITIAL_POSITION]  # @UndefinedVariable
+        return [p for p in Frame.Store.get(Pedestrian) if StoppedPedestrian.predicate(p)]  # @UndefinedVariable
     """() =>
         from p in Frame.Store.Get<Pedestrian>()
         where p.X.Equals(INITIAL_POSITION)
@@ -219,9 +231,13 @@ class StoppedPedestrian(Pedestrian):
 
 @SubSet(Pedestrian)
 class Walker(Pedestrian):
+    @staticmethod
+    def predicate(p):
+        return p.X != Pedestrian.INITIAL_POSITION
+
     @staticmethod
     def query():
-        return [p for p in Frame.Store.get(Pedestrian) if p.X != Pedestrian.INITIAL_POSITION]  # @UndefinedVariable
+        return [p for p in Frame.Store.get(Pedestrian) if Walker.predicate(p)]  # @UndefinedVariable
 
     """() =>
         from p in Frame.Store.Get<Pedestrian>()
@@ -5,14 +5,24 @@ Created on Dec 14, 2015
 '''
 from copy import deepcopy
 import json, sys
+import Queue
 import requests
+from requests.adapters import HTTPAdapter
+import socket
+from threading import Event, Thread
 import time
+import urllib
 import urllib2
+from urlparse import urlparse
 from uuid import uuid4, UUID
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
 
-from cadis.common.IStore import IStore
+from cadis.common import tracing
+from cadis.common.IStore import IStore, Delta
 from cadis.language import schema
 from cadis.language.schema import CADIS, CADISEncoder
+from cadis.language.codec import CODECS, JSONCodec
 import logging
 
 
@@ -52,39 +62,134 @@ class RemoteStore(IStore):
                     prop = data[dim._name]
                 setattr(obj, dim._name, prop)
             obj.ID = UUID(data["ID"])
+            if "_version" in data:
+                obj._version = data["_version"]
             objlist.append(obj)
         return objlist
 
     def delete(self, typeObj, obj):
         pass
 
+    def insert_all(self, t, objs, sim=None):
+        for obj in objs:
+            self.insert(obj, sim)
+
+    def delete_all(self, t, primkeys, sim=None):
+        pass
+
     def close(self):
         return
 
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path, timeout=None, **kwargs):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout, **kwargs)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None and self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, path, **kwargs):
+        HTTPConnectionPool.__init__(self, "localhost", **kwargs)
+        self.path = path
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return UnixHTTPConnection(self.path, timeout=self.timeout.connect_timeout)
+
+class UnixAdapter(HTTPAdapter):
+    '''
+    Transport for http+unix:// addresses, whose host is the quoted path of
+    the frame server's Unix domain socket. Connections are kept alive in a
+    pool per socket, as for TCP.
+    '''
+    def __init__(self, **kwargs):
+        super(UnixAdapter, self).__init__(**kwargs)
+        self.pools = {}
+
+    def get_connection(self, url, proxies=None):
+        path = urllib.unquote(urlparse(url).netloc)
+        pool = self.pools.get(path)
+        if pool is None:
+            pool = self.pools.setdefault(path, UnixHTTPConnectionPool(path, maxsize=self._pool_maxsize, block=self._pool_block))
+        return pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super(UnixAdapter, self).close()
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+def store_address(address):
+    '''
+    Frame server address as the remote stores use it: http://host:port/,
+    or unix:///path/to/socket for a frame server listening on a Unix domain
+    socket (frameserver.py --socket).
+    '''
+    if address.startswith("unix://"):
+        address = "http+unix://" + urllib.quote(address[len("unix://"):], safe='')
+    if not address.endswith('/'):
+        address += '/'
+    return address
+
+class TickSession(requests.Session):
+    '''
+    Session telling the frame server, when tracing, which tick of the
+    calling thread a request belongs to. Also speaks http+unix://.
+    '''
+    def __init__(self):
+        super(TickSession, self).__init__()
+        self.mount("http+unix://", UnixAdapter())
+
+    def request(self, method, url, **kwargs):
+        tick = getattr(tracing.current, "tick", None)
+        if tracing.tracer is not None and tick is not None:
+            headers = dict(kwargs.get("headers") or {})
+            headers['X-CADIS-Tick'] = str(tick)
+            kwargs["headers"] = headers
+        return super(TickSession, self).request(method, url, **kwargs)
+
 class PythonRemoteStore(IStore):
     __Logger = logging.getLogger(__name__)
-    def __init__(self, address="http://localhost:12000"):
+    def __init__(self, address="http://localhost:12000", codec="json"):
         '''
-        address: includes port. e.g. http://localhost:9000
-        sim: identifier name for the simulator using this store
+        address: includes port. e.g. http://localhost:9000, or the frame
+        server's socket, e.g. unix:///tmp/frameserver.sock
+        codec: wire format to ask the frame server for ("json" or "binary")
         '''
         self.encoder = CADISEncoder()
-        if not address.endswith('/'):
-            address += '/'
-        self.address = address
+        # JSON until the frame server accepts the requested codec on register
+        self.requested_codec = codec
+        self.codec = JSONCodec()
+        self.address = store_address(address)
+        # Pooled keep-alive connections shared by every request
+        self.session = TickSession()
 
     def insert(self, obj, sim):
         jsonobj = self.encoder.encode(obj)
-        response = requests.put("%s%s/%s" % (self.base_address, obj._FULLNAME, obj.ID), data={'obj' : jsonobj }, headers={'Content-Type':'application/json', 'InsertType':'Single'})
+        response = self.session.put("%s%s/%s" % (self.base_address, obj._FULLNAME, obj.ID), data={'obj' : jsonobj }, headers={'Content-Type':'application/json', 'InsertType':'Single'})
         return response
 
     def insert_all(self, t, list_obj, sim):
-        objs = self.encoder.encode(list_obj)
-        response = requests.put(self.base_address + t._FULLNAME, data={ 'insert_list' : objs }, headers={'InsertType':'Multiple'}, stream=True)
+        if self.codec.name != JSONCodec.name:
+            response = self.session.put(self.base_address + t._FULLNAME, data=self.codec.dumps(list_obj), headers={'Content-Type':self.codec.content_type, 'InsertType':'Multiple'})
+        else:
+            objs = self.encoder.encode(list_obj)
+            response = self.session.put(self.base_address + t._FULLNAME, data={ 'insert_list' : objs }, headers={'InsertType':'Multiple'})
+        if response.status_code == 400:
+            # The frame server rejected the whole list (see IStore.insert_all)
+            raise ValueError(json.loads(response.text)["error"])
         return response
 
     def get(self, typeObj):
-        resp = requests.get(self.base_address + typeObj._FULLNAME)
+        resp = self.session.get(self.base_address + typeObj._FULLNAME)
         jsonlist = json.loads(resp.text)
         objlist = []
         for data in jsonlist:
@@ -99,44 +204,61 @@ class PythonRemoteStore(IStore):
                     prop = data[dim._name]
                 setattr(obj, dim._name, prop)
             obj.ID = UUID(data["ID"])
+            if "_version" in data:
+                obj._version = data["_version"]
             objlist.append(obj)
         return objlist
 
+    def getobj(self, typeObj, key):
+        resp = self.session.get(self.base_address + typeObj._FULLNAME + '/%s' % key)
+        if resp.status_code == 404:
+            self.__Logger.error("Could not find key %s for object type %s", key, typeObj)
+            return None
+        return self.create_obj(typeObj, self.codec.loads(resp.content)[0])
+
     def register(self, sim):
         self.base_address = self.address + sim + '/'
-        resp = requests.put(self.base_address[:-1])
+        resp = self.session.put(self.base_address[:-1], headers={'X-CADIS-Codec':self.requested_codec})
         self.sim = sim
+        # Older frame servers do not answer the negotiation: stay with JSON
+        try:
+            accepted = resp.json()["codec"]
+        except Exception:
+            accepted = JSONCodec.name
+        if accepted != self.requested_codec:
+            self.__Logger.warn("frame server refused codec %s, using %s", self.requested_codec, accepted)
+        self.codec = CODECS.get(accepted, JSONCodec)()
         return resp
 
     def update_all(self, pushlist, sim):
         for t in pushlist:
             if len(pushlist[t]) > 0:
                 tmp = pushlist[t]
-                updates = self.encoder.encode({str(k):v for k, v in tmp.items()})
-                resp = requests.post(self.base_address + t._FULLNAME, data={'update_dict' : updates})
+                if self.codec.name != JSONCodec.name:
+                    self.session.post(self.base_address + t._FULLNAME, data=self.codec.dumps(tmp), headers={'Content-Type':self.codec.content_type})
+                else:
+                    updates = self.encoder.encode({str(k):v for k, v in tmp.items()})
+                    resp = self.session.post(self.base_address + t._FULLNAME, data={'update_dict' : updates})
             pushlist[t] = {}
 
     def create_obj(self, typeObj, data):
+        obj = None
         try:
-            obj = typeObj.__new__(typeObj)
-            for dim in obj._dimensions:
-                prop = getattr(obj, dim._name)
-                if hasattr(prop, "__decode__"):
-                    prop = prop.__decode__(data[dim._name])
-                else:
-                    prop = data[dim._name]
-                setattr(obj, dim._name, prop)
-            obj.ID = UUID(data["ID"])
+            obj = self.codec.decode_obj(typeObj, data)
         except Exception, e:
             self.__Logger.exception("Failed to create object from data %s", data)
         return obj
 
-    def getupdated(self, typeObj, sim, tracked_only=False):
+    def getupdated(self, typeObj, sim, tracked_only=False, deltas=False):
+        params = {'deltas' : 1} if deltas else None
         if tracked_only:
-            resp = requests.get(self.base_address + 'tracked/' + typeObj._FULLNAME)
+            resp = self.session.get(self.base_address + 'tracked/' + typeObj._FULLNAME, params=params)
         else:
-            resp = requests.get(self.base_address + 'updated/' + typeObj._FULLNAME)
-        jsonlist = json.loads(resp.text)
+            resp = self.session.get(self.base_address + 'updated/' + typeObj._FULLNAME, params=params)
+        jsonlist = self.codec.loads(resp.content)
+        return self.decode_updates(typeObj, jsonlist)
+
+    def decode_updates(self, typeObj, jsonlist):
         (new, mod, deleted) = jsonlist['new'], jsonlist['updated'], jsonlist['deleted']
         if typeObj not in schema.subsets:
             newobjlist = []
@@ -149,14 +271,189 @@ class PythonRemoteStore(IStore):
                 obj = self.create_obj(typeObj, data)
                 updatedobjlist.append(obj)
             for data in deleted:
-                deletedobjlist = [UUID(v) for v in deleted]
+                deletedobjlist = [self.codec.decode_key(v) for v in deleted]
+            for key, version, props in jsonlist.get('deltas', []):
+                updatedobjlist.append(Delta(self.codec.decode_key(key), version, self.codec.decode_props(typeObj, props)))
             return (newobjlist, updatedobjlist, deletedobjlist)
         else:
-            return ([UUID(v) for v in new], [UUID(v) for v in mod], [UUID(v) for v in deleted])
+            decode_key = self.codec.decode_key
+            return ([decode_key(v) for v in new], [decode_key(v) for v in mod], [decode_key(v) for v in deleted])
 
     def close(self):
+        self.session.close()
         return True
 
     def delete(self, typeObj, primkey, sim):
-        resp = requests.delete(self.base_address + typeObj._FULLNAME + '/%s' % primkey)
+        resp = self.session.delete(self.base_address + typeObj._FULLNAME + '/%s' % primkey)
         return resp
+
+    def delete_all(self, t, primkeys, sim):
+        keys = [self.codec.encode_key(k) for k in primkeys]
+        return self.session.delete(self.base_address + t._FULLNAME, data=self.codec.dumps(keys), headers={'Content-Type':self.codec.content_type})
+
+    def latency_summary(self):
+        # Latencies of the frame server's store operations (see histogram)
+        return self.session.get(self.address + 'stats/latency').json()
+
+class BatchedRemoteStore(PythonRemoteStore):
+    '''
+    Remote store that exchanges a whole tick with the frame server in a
+    single request: the frame's inserts, deletes and updates go up, and the
+    new/updated/deleted sets for every observed type come back.
+    '''
+    __Logger = logging.getLogger(__name__)
+
+    def sync(self, sim, inserts, deletes, updates, observed, deltas=False):
+        '''
+        inserts: { type : [ obj ] }
+        deletes: { type : [ primary_key ] }
+        updates: { type : { primary_key : { property_name : property_value } } }
+        observed: [ (type, tracked_only) ], in the order they must be fetched
+        deltas: updated objects may come back as Deltas (see getupdated)
+        '''
+        msg = {
+            "insert" : {t._FULLNAME : objs for t, objs in inserts.items() if len(objs) > 0},
+            "delete" : {t._FULLNAME : keys for t, keys in deletes.items() if len(keys) > 0},
+            "update" : {t._FULLNAME : {self.codec.encode_key(k): v for k, v in tmp.items()} for t, tmp in updates.items() if len(tmp) > 0},
+            "observe" : [(t._FULLNAME, tracked_only) for t, tracked_only in observed],
+            "deltas" : deltas
+        }
+        resp = self.session.post(self.base_address + 'sync', data=self.codec.dumps(msg), headers={'Content-Type':self.codec.content_type})
+        if resp.status_code == 400:
+            # The frame server rejected the writes (see insert_all)
+            raise ValueError(json.loads(resp.text)["error"])
+        jsonlist = self.codec.loads(resp.content)
+        res = {}
+        for t, _ in observed:
+            res[t] = self.decode_updates(t, jsonlist[t._FULLNAME])
+        return res
+
+class SubscribingRemoteStore(PythonRemoteStore):
+    '''
+    Remote store that has the frame server push changes instead of polling
+    for every type on every tick. A background thread keeps a long-poll
+    request open on the subscription channel and queues the deltas it
+    receives; drain() merges whatever arrived since the last pull, and
+    getupdated hands the merged changes out per type.
+    '''
+    __Logger = logging.getLogger(__name__)
+
+    def __init__(self, address="http://localhost:12000", codec="json", timeout=30):
+        '''
+        timeout: seconds the frame server may hold a long-poll request
+        '''
+        super(SubscribingRemoteStore, self).__init__(address, codec)
+        self.timeout = timeout
+        self.types = []
+        # Dictionary of type -> (new { key : obj }, mod { key : obj }, deleted set of keys)
+        self.pending = {}
+        self.queue = Queue.Queue()
+        self.listener = None
+        # Set by close: the listener stops at its next answer or retry
+        self.closing = Event()
+        self.deltas = False
+
+    def subscribe(self, sim, observed, deltas=False):
+        '''
+        observed: [ (type, tracked_only) ] whose changes are pushed to sim
+        deltas: updated objects may be pushed as Deltas (see getupdated)
+        '''
+        self.types = observed
+        self.deltas = deltas
+        for t, _ in observed:
+            self.pending[t] = ({}, {}, set())
+        msg = [(t._FULLNAME, tracked_only) for t, tracked_only in observed]
+        return self.session.put(self.base_address + 'subscribe', data=self.codec.dumps(msg), headers={'Content-Type':self.codec.content_type})
+
+    def listen(self):
+        # Own connection, so the open long-poll does not hold up other requests
+        session = TickSession()
+        # The first request returns right away with the current changes
+        timeout = 0
+        while not self.closing.is_set():
+            try:
+                params = {'timeout' : timeout, 'deltas' : 1 if self.deltas else 0}
+                resp = session.get(self.base_address + 'subscribe', params=params, timeout=self.timeout + 10)
+                if self.closing.is_set():
+                    break
+                msg = self.codec.loads(resp.content)
+                self.queue.put(dict((t, self.decode_updates(t, msg[t._FULLNAME])) for t, _ in self.types))
+                timeout = self.timeout
+            except Exception:
+                if self.closing.is_set():
+                    break
+                self.__Logger.exception("subscription request failed, retrying")
+                self.closing.wait(1)
+        session.close()
+
+    def drain(self):
+        if self.listener is None:
+            # Started lazily so that it runs in the simulator's own process
+            self.listener = Thread(target=self.listen)
+            self.listener.daemon = True
+            self.listener.start()
+            try:
+                self.merge(self.queue.get(timeout=self.timeout))
+            except Queue.Empty:
+                self.__Logger.warn("no answer from the frame server subscription yet")
+        while True:
+            try:
+                self.merge(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+    def merge(self, deltas):
+        for t, (new, mod, deleted) in deltas.items():
+            pnew, pmod, pdel = self.pending[t]
+            # Subset changes are lists of primary keys
+            subset = t in schema.subsets
+            for o in new:
+                key = o if subset else o._primarykey
+                if key in pdel:
+                    # Deleted and added again since the last pull
+                    pdel.remove(key)
+                    pmod[key] = o
+                else:
+                    pnew[key] = o
+            for o in mod:
+                key = o if subset else o._primarykey
+                if isinstance(o, Delta):
+                    # Changes of an object still pending are added to it
+                    if key in pnew:
+                        pnew[key] = o.apply(pnew[key])
+                    elif key in pmod:
+                        pmod[key] = o.apply(pmod[key])
+                    else:
+                        pmod[key] = o
+                elif key in pnew:
+                    pnew[key] = o
+                else:
+                    pmod[key] = o
+            for key in deleted:
+                if key in pnew:
+                    # Added and deleted since the last pull
+                    del pnew[key]
+                else:
+                    pmod.pop(key, None)
+                    pdel.add(key)
+
+    def getupdated(self, typeObj, sim, tracked_only=False, deltas=False):
+        if typeObj not in self.pending:
+            return super(SubscribingRemoteStore, self).getupdated(typeObj, sim, tracked_only, deltas)
+        (pnew, pmod, pdel) = self.pending[typeObj]
+        self.pending[typeObj] = ({}, {}, set())
+        return (pnew.values(), pmod.values(), list(pdel))
+
+    def close(self):
+        '''
+        Stops the listener. The frame server answers the pending long-poll
+        when the subscription is cancelled, so this does not wait for it.
+        '''
+        self.closing.set()
+        if self.listener is not None:
+            try:
+                self.session.delete(self.base_address + 'subscribe', timeout=5)
+            except Exception:
+                self.__Logger.warn("could not cancel the subscription of %s", self.sim)
+            self.listener.join(5)
+        return super(SubscribingRemoteStore, self).close()
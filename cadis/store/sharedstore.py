@@ -0,0 +1,328 @@
+'''
+Store for simulators running as processes on one host, exchanging their
+writes through shared memory instead of a frame server.
+
+Each process keeps its own SimpleStore, the replica its simulators read
+from, and every write goes through a commit log in a memory segment that
+all the processes map:
+
+- a commit encodes the simulator's push once (with BinaryCodec: objects
+  by their dimensions, value types as packed doubles) into slots of the
+  segment, appends an entry pointing to them to the log, and applies it to
+  the writer's replica. Commits are serialized by a lock shared by the
+  processes, so the log gives every commit its place in one order.
+- before reading (pin, get), a process replays the log entries written by
+  the other processes since its last read into its replica, as commits of
+  the simulator that made them. Subsets, permutations, versions and the
+  per-type change logs are then those of SimpleStore.
+- each simulator has a cursor in the segment, the first entry it has not
+  read. Slots and entries every simulator has read are reused; a writer
+  that finds the segment full waits for the slowest reader, up to
+  WRITE_TIMEOUT seconds.
+
+This is a replicated log, not a shared table: every process holds a full
+replica of the store and decodes every commit of the others. Processes
+cannot share Python objects, so reading from a shared table would decode
+the objects a simulator reads on each pull anyway, and the replica would
+still be needed for versions, views and change logs. Replaying costs one
+decode per commit and process, paid when the simulator pulls, and reads
+are then dictionary lookups. Memory grows with one replica per connector
+process (a handful), and the segment itself is bounded. Each replica only
+keeps versions for the simulators it hosts (the ones pinning or
+committing through it): simulators registered before the fork but read
+from another process do not hold back its reclaim.
+
+The segment and the lock are created with the first store, and inherited
+by the processes forked after that (the Controller creates the stores
+before starting the connectors). Simulators must register before the
+first write is reclaimed to see the objects written before they
+registered.
+'''
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+from cadis.common.IStore import IStore
+from cadis.language.codec import BinaryCodec
+from cadis.store.simplestore import SimpleStore
+
+# Default segment size, in MB
+SEGMENT_SIZE = 256
+# Bytes per data slot; a commit takes as many consecutive slots as it needs
+SLOT_SIZE = 256
+# Log entries held at once
+LOG_ENTRIES = 1 << 16
+# Simulators that may register
+MAX_SIMS = 64
+# Seconds a writer waits for the readers to free space
+WRITE_TIMEOUT = 30.0
+
+# head (next entry), tail (oldest entry kept), wpos (next slot), rpos (oldest slot kept)
+HEADER = struct.Struct("<QQQQ")
+# seq, writer pid, start slot, end slot, payload bytes
+ENTRY = struct.Struct("<QIQQI")
+# name, cursor, active
+SIM = struct.Struct("<64sQB")
+
+class SharedMemoryStore(IStore):
+    __Logger = logging.getLogger(__name__)
+    # Shared by every store of the process tree (see module doc)
+    segment = None
+    lock = None
+
+    # Process state, copied into the forked processes
+    # Replica the process' simulators read from
+    replica = None
+    # Next log entry to replay
+    replayed = 0
+    # Simulators reading through this process, whose cursors it moves
+    hosted = set()
+    # Serializes replays and commits of the process' threads
+    local = threading.RLock()
+    codec = BinaryCodec()
+
+    def __init__(self, size=SEGMENT_SIZE, slot_size=SLOT_SIZE, entries=LOG_ENTRIES):
+        '''
+        size: segment size in MB, slot_size and entries: see module doc.
+        Only the first store of the process tree creates the segment.
+        '''
+        cls = SharedMemoryStore
+        if cls.segment is None:
+            self.__Logger.info("creating a %d MB shared memory segment", size)
+            cls.slot_size = slot_size
+            cls.entries = entries
+            cls.logoffset = HEADER.size + MAX_SIMS * SIM.size
+            cls.dataoffset = cls.logoffset + entries * ENTRY.size
+            cls.nslots = (size * 1024 * 1024 - cls.dataoffset) // slot_size
+            # Anonymous and shared: the processes forked later map it too
+            cls.segment = mmap.mmap(-1, cls.dataoffset + cls.nslots * slot_size, mmap.MAP_SHARED)
+            cls.lock = multiprocessing.Lock()
+            cls.replica = SimpleStore()
+            # The simulators of other processes never read from this replica
+            cls.replica.hosted = cls.hosted
+        self.name2class = SimpleStore.name2class
+
+    ######################################################
+    ## Segment
+    ######################################################
+    def header(self):
+        return HEADER.unpack_from(self.segment, 0)
+
+    def set_header(self, head, tail, wpos, rpos):
+        HEADER.pack_into(self.segment, 0, head, tail, wpos, rpos)
+
+    def entry(self, seq):
+        return ENTRY.unpack_from(self.segment, self.logoffset + (seq % self.entries) * ENTRY.size)
+
+    def sims(self):
+        # [ (index, name, cursor) ] of the registered simulators
+        res = []
+        for i in range(MAX_SIMS):
+            name, cursor, active = SIM.unpack_from(self.segment, HEADER.size + i * SIM.size)
+            if active:
+                res.append((i, name.rstrip('\0'), cursor))
+        return res
+
+    def set_sim(self, index, name, cursor, active=True):
+        SIM.pack_into(self.segment, HEADER.size + index * SIM.size, name, cursor, active)
+
+    def set_cursors(self, seq):
+        for i, name, _ in self.sims():
+            if name in self.hosted:
+                self.set_sim(i, name, seq)
+
+    def reclaim(self):
+        # Frees the entries and slots every simulator has read
+        head, tail, wpos, rpos = self.header()
+        low = min([cursor for _, _, cursor in self.sims()] + [head])
+        while tail < low:
+            _, _, _, end, _ = self.entry(tail)
+            rpos = end
+            tail += 1
+        self.set_header(head, tail, wpos, rpos)
+
+    def allocate(self, nbytes):
+        '''
+        Start and end slots (counted from the start of the run) for a
+        payload, None if there is no room until the readers catch up.
+        '''
+        needed = (nbytes + self.slot_size - 1) // self.slot_size
+        if needed > self.nslots:
+            raise ValueError("commit of %d bytes does not fit in the shared memory segment" % nbytes)
+        head, tail, wpos, rpos = self.header()
+        if head - tail >= self.entries:
+            return None
+        start = wpos
+        if start % self.nslots + needed > self.nslots:
+            # Payloads are contiguous: skip the slots left at the end
+            start += self.nslots - start % self.nslots
+        if start + needed - rpos > self.nslots:
+            return None
+        return start, start + needed
+
+    ######################################################
+    ## Log
+    ######################################################
+    def replay(self):
+        '''
+        Applies the commits of the other processes to the replica, in log
+        order. Commits of this process were applied when made.
+        '''
+        with self.local:
+            head = self.header()[0]
+            pid = os.getpid()
+            # Updates of consecutive commits of one simulator are applied
+            # as one: nothing reads the replica in between
+            merged = None
+            while self.replayed < head:
+                seq, wpid, start, end, nbytes = self.entry(self.replayed)
+                SharedMemoryStore.replayed += 1
+                if wpid == pid:
+                    continue
+                offset = self.dataoffset + (start % self.nslots) * self.slot_size
+                sim, inserts, deletes, updates = self.decode(self.segment[offset:offset + nbytes])
+                if merged and merged[0] == sim and not inserts and not deletes:
+                    for t, update_dict in updates.items():
+                        pending = merged[1].setdefault(t, {})
+                        for primkey, props in update_dict.items():
+                            pending.setdefault(primkey, {}).update(props)
+                    continue
+                if merged:
+                    self.replica.commit(merged[0], {}, {}, merged[1])
+                    merged = None
+                if not inserts and not deletes:
+                    merged = (sim, updates)
+                else:
+                    self.replica.commit(sim, inserts, deletes, updates)
+            if merged:
+                self.replica.commit(merged[0], {}, {}, merged[1])
+
+    def catch_up(self):
+        '''
+        Replays the log before a read, then moves the cursors of the hosted
+        simulators past what was replayed. The cursors are read by writers
+        reclaiming space, so they are only written under the shared lock.
+        '''
+        with self.local:
+            replayed = self.replayed
+            self.replay()
+            if self.replayed != replayed:
+                with self.lock:
+                    self.set_cursors(self.replayed)
+
+    def commit(self, sim, inserts, deletes, updates, check=False):
+        '''
+        Applies a simulator's push as one store version, in the log and in
+        the process' replica. check: see SimpleStore.commit
+        '''
+        if not any(inserts.values()) and not any(deletes.values()) and not any(updates.values()):
+            return
+        SharedMemoryStore.hosted.add(sim)
+        payload = self.encode(sim, inserts, deletes, updates)
+        deadline = time.time() + WRITE_TIMEOUT
+        while True:
+            with self.local:
+                with self.lock:
+                    # Commits of others first, so the replica applies the log in order
+                    self.replay()
+                    self.set_cursors(self.replayed)
+                    if check:
+                        # The replica only changes under the process' lock
+                        self.replica.check_types(inserts)
+                        self.replica.check_inserts(inserts)
+                    self.reclaim()
+                    slots = self.allocate(len(payload))
+                    if slots is not None:
+                        start, end = slots
+                        offset = self.dataoffset + (start % self.nslots) * self.slot_size
+                        self.segment[offset:offset + len(payload)] = payload
+                        head, tail, _, rpos = self.header()
+                        ENTRY.pack_into(self.segment, self.logoffset + (head % self.entries) * ENTRY.size,
+                                        head, os.getpid(), start, end, len(payload))
+                        self.replica.commit(sim, inserts, deletes, updates)
+                        # Published last: readers only go up to head
+                        self.set_header(head + 1, tail, end, rpos)
+                        return
+                    behind = [name for _, name, cursor in self.sims() if cursor == self.header()[1]]
+            if time.time() > deadline:
+                raise RuntimeError("shared memory store full, waiting for %s to read" % ", ".join(behind))
+            time.sleep(0.01)
+
+    def encode(self, sim, inserts, deletes, updates):
+        byname = lambda d: dict((t._FULLNAME, v) for t, v in d.items() if v)
+        return self.codec.dumps([sim, byname(inserts), byname(deletes), byname(updates)])
+
+    def decode(self, data):
+        sim, inserts, deletes, updates = self.codec.loads(data)
+        bytype = lambda d: dict((self.name2class[t], v) for t, v in d.items())
+        return sim, bytype(inserts), bytype(deletes), bytype(updates)
+
+    ######################################################
+    ## Simulators
+    ######################################################
+    def register(self, sim):
+        with self.lock:
+            head = self.header()[0]
+            sims = self.sims()
+            for i, name, _ in sims:
+                if name == sim:
+                    break
+            else:
+                used = set(i for i, _, _ in sims)
+                free = [i for i in range(MAX_SIMS) if i not in used]
+                if not free:
+                    raise RuntimeError("more than %d simulators registered in the shared memory store" % MAX_SIMS)
+                if self.header()[1] > 0:
+                    self.__Logger.warn("%s registered after writes were reclaimed, it will not see them", sim)
+                # Reads the log from the oldest entry still held
+                self.set_sim(free[0], sim, self.header()[1])
+        self.replica.register(sim)
+
+    def close(self):
+        return
+
+    ######################################################
+    ## IStore
+    ######################################################
+    def pin(self, sim):
+        SharedMemoryStore.hosted.add(sim)
+        self.catch_up()
+        return self.replica.pin(sim)
+
+    def unpin(self, sim):
+        self.replica.unpin(sim)
+
+    def insert(self, obj, sim):
+        self.commit(sim, {obj.__class__ : [obj]}, {}, {})
+
+    def insert_all(self, t, objs, sim):
+        self.commit(sim, {t : objs}, {}, {}, check=True)
+
+    def update(self, t, update_dict, sim):
+        self.commit(sim, {}, {}, {t : update_dict})
+
+    def update_all(self, pushlist, sim):
+        self.commit(sim, {}, {}, pushlist)
+
+    def delete(self, typeObj, primkey, sim):
+        self.commit(sim, {}, {typeObj : [primkey]}, {})
+
+    def delete_all(self, t, primkeys, sim):
+        self.commit(sim, {}, {t : primkeys}, {})
+
+    def get(self, typeObj, copy_objs=True):
+        self.catch_up()
+        return self.replica.get(typeObj, copy_objs)
+
+    def getobj(self, typeObj, key):
+        return self.replica.getobj(typeObj, key)
+
+    def getupdated(self, typeObj, sim, copy_objs=True, tracked_only=False, deltas=False):
+        return self.replica.getupdated(typeObj, sim, copy_objs, tracked_only, deltas)
+
+    def count(self, typeObj):
+        return self.replica.count(typeObj)
@@ -4,132 +4,190 @@ Created on Dec 14, 2015
 @author: Arthur Valadares
 '''
 from __builtin__ import type
+from bisect import bisect_right
 from copy import copy, deepcopy
 import httplib
 import logging
+import itertools
 import sys
 import threading
+from uuid import UUID
 
-from cadis.common.IStore import IStore
+from cadis.common.IStore import IStore, Delta
 from cadis.language import schema
 from cadis.language.schema import StorageObjectFactory, \
-    PermutationObjectfactory, permutationsets, subsets
+    PermutationObjectfactory, permutationsets, permutedclss, permutations, subsets
 import time
 from cadis.common import util
+from cadis.common.histogram import Histograms
+from cadis.common import tracing
+
+# Kinds of change recorded in a ChangeLog
+INSERTED = 0
+UPDATED = 1
+DELETED = 2
+
+# Property values copies may share: none can be changed in place
+IMMUTABLE = (basestring, int, long, float, bool, type(None), UUID)
+
+def private(value):
+    if isinstance(value, IMMUTABLE):
+        return value
+    return deepcopy(value)
+
+def private_copy(obj):
+    '''
+    Copy of obj holding its own copies of mutable property values (Vector3,
+    lists...), so that changing one in place does not change obj.
+    '''
+    res = copy(obj)
+    for dim in res._dimensions:
+        value = dim.fget(res)
+        if not isinstance(value, IMMUTABLE) and dim.fset:
+            dim.fset(res, deepcopy(value))
+    return res
 
 class SubSetFrameUpdate(object):
-    def __init__(self, t, store):
+    '''
+    Membership of a queried subset (one without a predicate) as last seen
+    by a simulator.
+    '''
+    def __init__(self, t):
         self.objtype = schema.setsof[t]
         self.subsettype = t
-        self.store = store
         self.objectids = set()
-        self.object_dicts = {}
-
-    def get_update(self, newobjids):
-        tmp_object_dicts = {}
-        # Calculate set of new objects since last query
-        new = []
-        for primkey in newobjids.difference(self.objectids):
-            newobj = self.store[self.objtype][primkey]
-            new.append(primkey)
-            tmp_object_dicts[primkey] = str(newobj.__dict__)
-
-        # Calculate set of deleted objects
-        deleted = []
-        for primkey in self.objectids.difference(newobjids):
-            deleted.append(primkey)
-
-        # Calculate set of modified objects
-        mod = []
-        for primkey in newobjids.intersection(self.objectids):
-            newobj = self.store[self.objtype][primkey]
-            strdictnew = str(newobj.__dict__)
-            if strdictnew != self.object_dicts[primkey]:
-                mod.append(primkey)
-                tmp_object_dicts[primkey] = strdictnew
-            else:
-                tmp_object_dicts[primkey] = self.object_dicts[primkey]
+        # Store version the last query ran against
+        self.seen = None
 
-        self.object_dicts = tmp_object_dicts
-        self.objectids = set(self.object_dicts.keys())
+    def get_update(self, newobjids, log, version):
+        '''
+        newobjids: members at version. log: change log of the parent type;
+        members are modified if the log has a change to them since the last
+        query, so only the changed objects are looked at.
+        '''
+        members = set(newobjids)
+        new = list(members.difference(self.objectids))
+        deleted = list(self.objectids.difference(members))
+        kept = members.intersection(self.objectids)
+        if self.seen is None:
+            mod = []
+        elif self.seen < log.floor:
+            # Changes since the last query were reclaimed
+            mod = list(kept)
+        else:
+            changed = set(primkey for _, _, primkey, _, _ in log.since(self.seen, version))
+            mod = list(kept.intersection(changed))
+        self.objectids = members
+        self.seen = version
         return (new, mod, deleted)
 
-class FrameUpdate(object):
-    def __init__(self, t, store):
-        self.added = set()
-        self.updated = set()
-        self.deleted = set()
-        self.storageobj = set()
-        self.objtype = t
-        self.store = store
-
-    def clear(self):
-        self.added.clear()
-        self.updated.clear()
-        self.deleted.clear()
-
-    def add(self, o):
-        self.added.add(o._primarykey)
-        if hasattr(o, "_storageobj"):
-            self.storageobj.add(o._primarykey)
-
-    def update(self, o):
-        self.updated.add(o._primarykey)
-        if hasattr(o, "_storageobj"):
-            self.storageobj.add(o._primarykey)
-
-    def delete(self, primkey):
-        if primkey in self.added:
-            self.added.remove(primkey)
-        if primkey in self.updated:
-            self.updated.remove(primkey)
-        self.deleted.add(primkey)
-
-    def updatelist(self, clear=False, copy_objs=True):
-        cp_added = copy(self.added)
-        cp_updated = copy(self.updated)
-        cp_deleted = copy(self.deleted)
-
-        if clear:
-            self.clear()
-
-        added = []
-        updated = []
-        deleted = []
-        for key in cp_added:
-            if key not in self.store[self.objtype]:
-                continue
-            if key in self.storageobj:
-                added.append(PermutationObjectfactory(self.store[self.objtype][key]))
-            else:
-                if copy_objs:
-                    added.append(deepcopy(self.store[self.objtype][key]))
-                else:
-                    added.append(self.store[self.objtype][key])
-        for key in cp_updated:
-            if key not in self.store[self.objtype]:
-                continue
-            if key in self.storageobj:
-                updated.append(PermutationObjectfactory(self.store[self.objtype][key]))
-            else:
-                if copy_objs:
-                    updated.append(deepcopy(self.store[self.objtype][key]))
-                else:
-                    updated.append(self.store[self.objtype][key])
-        for key in cp_deleted:
-            deleted.append(key)
+class ChangeLog(object):
+    '''
+    Changes committed to one type, in version order. Entries are appended
+    by writers holding the type's lock and read without locks: reclaim
+    swaps in new lists instead of trimming them, so readers holding the
+    old ones are not disturbed.
+    '''
+    def __init__(self):
+        # (versions, [ (sim, primary_key, kind, property names) ]). Property
+        # names are those of an update, None when unknown
+        self.entries = ([], [])
+        # Entries up to this version were reclaimed
+        self.floor = 0
+
+    def append(self, version, sim, primkey, kind, props=None):
+        versions, changes = self.entries
+        changes.append((sim, primkey, kind, props))
+        # Appended last: readers find a change through its version
+        versions.append(version)
+
+    def since(self, start, end):
+        '''
+        Changes with start < version <= end, as
+        (version, sim, primary_key, kind, property names)
+        '''
+        versions, changes = self.entries
+        res = []
+        for i in xrange(bisect_right(versions, start), len(versions)):
+            version = versions[i]
+            if version > end:
+                break
+            res.append((version,) + changes[i])
+        return res
+
+    def changed_by_others(self, start, end, sim):
+        '''
+        True if a simulator other than sim made a change with
+        start < version <= end. View membership changes count for everyone.
+        '''
+        versions, changes = self.entries
+        for i in xrange(bisect_right(versions, start), len(versions)):
+            if versions[i] > end:
+                break
+            if changes[i][0] != sim:
+                return True
+        return False
+
+    def reclaim(self, low):
+        '''
+        Drops the changes up to version low and returns their primary keys.
+        '''
+        versions, changes = self.entries
+        i = bisect_right(versions, low)
+        if i == 0:
+            return []
+        self.entries = (versions[i:], changes[i:])
+        self.floor = max(self.floor, versions[i - 1])
+        return [primkey for _, primkey, _, _ in changes[:i]]
+
+class TypeLocks(object):
+    '''
+    Holds the locks of several types. Locks are always taken in type name
+    order, so operations spanning more than one type cannot deadlock.
+    '''
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for l in self.locks:
+            l.acquire()
+        return self
 
-        return (added, updated, deleted)
+    def __exit__(self, exc_type, exc_value, tb):
+        for l in reversed(self.locks):
+            l.release()
+        return False
 
 class SimpleStore(IStore):
     '''
-    classdocs
+    Multi-version store. Every push is committed as one new store version:
+    writers apply it to the live objects under the locks of the types
+    involved, and append a frozen copy of each changed object to its
+    version chain and an entry to the type's change log. The version is
+    published once every earlier version is, so readers pinned to the
+    committed version see whole pushes, and read without any lock.
+
+    Each simulator has a cursor per type (the version it has read up to);
+    chain and log entries older than every cursor are reclaimed.
     '''
     app = None
+    # Live objects: type -> { primary_key : object }, changed by writers only
     store = {}
     subsets = {}
+    # Dictionary of type -> { primary_key : [ (version, frozen object or None if deleted) ] }
+    chains = {}
+    # Dictionary of type -> ChangeLog, for sets, permutations and views
+    changelogs = {}
+    # Dictionary of subset -> set of member keys, for subsets with a predicate
+    views = {}
+    # Monotonically increasing version stamp, one per commit
+    versionclock = itertools.count(1)
     name2class = {}
-    lock = threading.RLock()
+    # Dictionary of type -> lock. Only writers lock, and operations on
+    # different types do not block each other (see writing)
+    locks = {}
+    # Notified whenever a new version is published (see wait_for_updates)
+    changed = threading.Condition(threading.Lock())
     __Logger = logging.getLogger(__name__)
 
     def __new__(cls, *args, **kwargs):
@@ -147,62 +205,383 @@ class SimpleStore(IStore):
         '''
         if not self._initialized:
             self.updates4sim = {}
+            # Last version visible to readers
+            self.committed = 0
+            # Versions whose commit finished, waiting for an earlier one
+            self.finished = set()
+            # Dictionary of sim -> { type : version read up to }
+            self.cursors = {}
+            # Dictionary of sim -> version the simulator registered at
+            self.registered = {}
+            # Dictionary of sim -> version its current pull reads (see pin)
+            self.pins = {}
+            # Simulators that pulled at least once
+            self.pulled = set()
+            # Simulators reading from this store, None for every registered
+            # one (see SharedMemoryStore, whose replicas only serve some)
+            self.hosted = None
+            # Version read by subset queries running on this thread
+            self.reader = threading.local()
 
             for t in schema.sets.union(schema.permutationsets):
                 if t not in self.store:
                     self.store[t] = {}
+                    self.chains[t] = {}
+                    self.changelogs[t] = ChangeLog()
+                    self.locks[t] = threading.RLock()
                     SimpleStore.name2class[t._FULLNAME] = t
             for t in schema.subsets:
                 if t not in self.subsets:
                     self.subsets[t] = {}
+                    self.locks[t] = threading.RLock()
                     SimpleStore.name2class[t._FULLNAME] = t
+                # Subsets defining a per-object predicate are maintained
+                # incrementally by the writers instead of queried
+                if hasattr(t, "predicate") and t not in self.views:
+                    self.views[t] = set()
+                    self.changelogs[t] = ChangeLog()
             self._initialized = True
 
     def register(self, sim):
-        self.updates4sim[sim] = {}
-        for t in schema.sets.union(schema.permutationsets):
-            self.updates4sim[sim][t] = FrameUpdate(t, self.store)
-        for t in schema.subsets:
-            self.updates4sim[sim][t] = SubSetFrameUpdate(t, self.store)
+        with self.writing(*self.locks.keys()):
+            self.updates4sim[sim] = {}
+            for t in schema.subsets:
+                if t not in self.views:
+                    self.updates4sim[sim][t] = SubSetFrameUpdate(t)
+            self.cursors[sim] = {}
+            self.registered[sim] = self.committed
 
-    def insert(self, obj, sim):
-        with self.lock:
-            newobjs = []
-            cls = obj.__class__
-            # Only accepts inserts of sets and permutations
-            if cls not in self.store:
-                # self.store[obj.__class__] = {}
-                self.__Logger.error("ERROR! Object type supposed to exist in store")
-                return False
-            if obj._primarykey in self.store[cls]:
-                # new = True
-                self.__Logger.error("ERROR! Insert should only be used for new items")
-                return False
-
-            # if this class is a permutation of others, create permutations
-            if hasattr(obj, "__dimensiontable__"):
-                # newobj is the object we will keep in the Store
-                # it is just a dictionary of property -> other objects in store
-                obj, newobjs = self.CreatePermutationObject(obj)
-                self.store[cls][obj._primarykey] = obj
+    def lockset(self, t, res=None):
+        '''
+        Types whose locks a write to type t needs: a permutation also writes
+        the types it is made of, and a write to a type refreshes the
+        permutations made of it.
+        '''
+        if res is None:
+            res = set()
+        if t in res:
+            return res
+        res.add(t)
+        if t in schema.setsof:
+            self.lockset(schema.setsof[t], res)
+        for of in permutedclss.get(t, []):
+            self.lockset(of, res)
+        for pt in permutations.get(t, []):
+            self.lockset(pt, res)
+        return res
+
+    def writing(self, *types):
+        '''
+        Context manager holding the locks of the given types and of the
+        types they depend on (see lockset). Every lock an operation needs
+        must be taken in one call, so that the ordering holds.
+        '''
+        return TypeLocks([self.locks[t] for t in sorted(self.related(types), key=lambda t: t._FULLNAME)])
+
+    def related(self, types):
+        needed = set()
+        for t in types:
+            self.lockset(t, needed)
+        return needed
+
+    ######################################################
+    ## Versions
+    ######################################################
+    def commit(self, sim, inserts, deletes, updates, check=False):
+        '''
+        Applies a simulator's push as one store version.
+        inserts: { type : [ obj ] }
+        deletes: { type : [ primary_key ] }
+        updates: { type : { primary_key : { property_name : property_value } } }
+        check: raise ValueError, without applying anything, if an insert
+        would be skipped (see check_inserts)
+        '''
+        types = [t for t in inserts if len(inserts[t]) > 0] + \
+            [t for t in deletes if len(deletes[t]) > 0] + \
+            [t for t in updates if len(updates[t]) > 0]
+        if not types:
+            return
+        if check:
+            self.check_types(inserts)
+        with self.writing(*types):
+            if check:
+                self.check_inserts(inserts)
+            # Taken with the locks held, so versions of a type are in order
+            version = next(SimpleStore.versionclock)
+            try:
+                for t in inserts:
+                    for obj in inserts[t]:
+                        self.apply_insert(obj, sim, version)
+                for t in deletes:
+                    for primkey in deletes[t]:
+                        self.apply_delete(t, primkey, sim, version)
+                for t in updates:
+                    self.apply_update(t, updates[t], sim, version)
+                for t in self.reclaimed(types):
+                    self.reclaim(t)
+            finally:
+                self.publish(version)
+
+    def check_types(self, inserts):
+        # Before taking the locks, which only exist for the known types
+        for t in inserts:
+            for obj in inserts[t]:
+                if obj.__class__ not in self.store:
+                    raise ValueError("cannot insert an object of unknown type %s" % obj.__class__.__name__)
+
+    def check_inserts(self, inserts):
+        '''
+        Raises ValueError on the first object apply_insert would skip: one
+        whose key is in the store already, or twice in the inserts.
+        '''
+        for t in inserts:
+            keys = set()
+            for obj in inserts[t]:
+                cls = obj.__class__
+                if obj._primarykey in self.store[cls]:
+                    raise ValueError("object %s of type %s is already in the store" % (obj._primarykey, cls._FULLNAME))
+                if (cls, obj._primarykey) in keys:
+                    raise ValueError("object %s of type %s is inserted twice" % (obj._primarykey, cls._FULLNAME))
+                keys.add((cls, obj._primarykey))
+
+    def reclaimed(self, types):
+        # Types whose logs a commit to types may have appended to: the
+        # related types and their predicate views
+        res = self.related(types)
+        for t in list(res):
+            for st in schema.subsetsof.get(t, []):
+                if st in self.views:
+                    res.add(st)
+        return res
+
+    def publish(self, version):
+        # Versions become visible in order: a commit finishing before an
+        # earlier one leaves it to that one to publish both
+        with self.changed:
+            self.finished.add(version)
+            while self.committed + 1 in self.finished:
+                self.finished.remove(self.committed + 1)
+                self.committed += 1
+            self.changed.notify_all()
+
+    def pin(self, sim):
+        '''
+        Pins the reads of a simulator's pull to the current committed version,
+        so that all types are read at the same version. The pull ends with
+        unpin.
+        '''
+        with self.changed:
+            self.pins[sim] = self.committed
+            self.pulled.add(sim)
+            return self.pins[sim]
+
+    def unpin(self, sim):
+        # The pull is done: its version no longer holds back reclaim
+        with self.changed:
+            self.pins.pop(sim, None)
+
+    def readversion(self, sim=None):
+        if hasattr(self.reader, "version"):
+            return self.reader.version
+        if sim in self.pins:
+            return self.pins[sim]
+        return self.committed
+
+    def record(self, t, primkey, sim, version, kind, props=None):
+        '''
+        Appends the version of a changed object to its chain and the change
+        to the type's log. Predicate views and permutations made of t are
+        brought up to date at the same version.
+        props: names of the properties an update changed, None if unknown
+        '''
+        if kind == DELETED:
+            frozen = None
+        else:
+            obj = self.store[t][primkey]
+            # Versions share nothing with the live object or the readers:
+            # readers get private copies too
+            if hasattr(obj, "_storageobj"):
+                frozen = private_copy(PermutationObjectfactory(obj))
             else:
-                self.store[cls][obj._primarykey] = deepcopy(obj)
-
-            # TODO: There's a better way of doing this..
-            for s in self.updates4sim.keys():
-                if s != sim and cls in self.updates4sim[s]:
-                    try:
-                        self.updates4sim[s][cls].add(obj)
-                    except:
-                        self.__Logger.exception("Failed to add update to update list.")
+                frozen = private_copy(obj)
+            # Sent along with the object, so readers can tell if it changed
+            frozen._version = version
+        chain = self.chains[t].get(primkey)
+        if chain is None:
+            self.chains[t][primkey] = [(version, frozen)]
+        elif chain[-1][0] == version:
+            # Changed more than once by the same commit
+            chain[-1] = (version, frozen)
+        else:
+            chain.append((version, frozen))
+        self.changelogs[t].append(version, sim, primkey, kind, props)
+
+        if t in schema.subsetsof:
+            for st in schema.subsetsof[t]:
+                if st in self.views:
+                    self.evaluate_view(st, primkey, frozen, version)
+        if kind == UPDATED:
+            for pt in permutations.get(t, []):
+                if primkey in self.store[pt]:
+                    self.record(pt, primkey, sim, version, UPDATED)
+
+    def evaluate_view(self, t, primkey, obj, version):
+        members = self.views[t]
+        # Membership changes go to every simulator, including the writer
+        if obj is not None and t.predicate(obj):
+            if primkey in members:
+                self.changelogs[t].append(version, None, primkey, UPDATED)
+            else:
+                members.add(primkey)
+                self.changelogs[t].append(version, None, primkey, INSERTED)
+        elif primkey in members:
+            members.remove(primkey)
+            self.changelogs[t].append(version, None, primkey, DELETED)
+
+    def at(self, t, primkey, version):
+        # Newest version of an object not newer than version, None if missing
+        chain = self.chains[t].get(primkey)
+        if chain:
+            for v, obj in reversed(chain):
+                if v <= version:
+                    return obj
+        return None
+
+    def committed_objects(self, t, version):
+        res = []
+        for chain in self.chains[t].values():
+            v, obj = chain[-1]
+            if v > version:
+                for v, obj in reversed(chain):
+                    if v <= version:
+                        break
+                else:
+                    continue
+            if obj is not None:
+                res.append(obj)
+        return res
+
+    def low_watermark(self, t):
+        # Oldest version some simulator may still read changes of t from
+        # Once a simulator pulled, types it does not read do not hold back:
+        # if it starts reading one, the first read returns the whole type
+        # (see changes)
+        # Simulators reading elsewhere do not hold back either, for the same
+        # reason
+        low = self.committed
+        for sim, cursors in self.cursors.items():
+            if self.hosted is not None and sim not in self.hosted:
+                continue
+            if t in cursors:
+                low = min(low, cursors[t])
+            elif sim not in self.pulled:
+                low = min(low, self.registered[sim])
+        # Subset queries find their modified members in the parent's log
+        for trackers in self.updates4sim.values():
+            for tracker in trackers.values():
+                if tracker.objtype == t and tracker.seen is not None:
+                    low = min(low, tracker.seen)
+        # Pulls in progress may read any type at their pinned version
+        with self.changed:
+            pinned = self.pins.values()
+        for v in pinned:
+            low = min(low, v)
+        return low
+
+    def reclaim(self, t):
+        if t not in self.changelogs:
+            return
+        low = self.low_watermark(t)
+        keys = self.changelogs[t].reclaim(low)
+        if t not in self.chains:
+            return
+        for primkey in set(keys):
+            chain = self.chains[t].get(primkey)
+            if not chain:
+                continue
+            # Keep the newest version not newer than low, and all later ones
+            i = len(chain) - 1
+            while i > 0 and chain[i][0] > low:
+                i -= 1
+            if i == len(chain) - 1 and chain[i][0] <= low and chain[i][1] is None:
+                # Deleted before anyone could still read it
+                del self.chains[t][primkey]
+            elif i > 0:
+                self.chains[t][primkey] = chain[i:]
+
+    ######################################################
+    ## Subscriptions
+    ######################################################
+    def has_updates(self, sim, types):
+        cursors = self.cursors.get(sim, {})
+        for t, tracked_only in types:
+            if t in self.changelogs:
+                start = cursors.get(t, self.registered.get(sim, 0))
+                # The simulator's own writes do not answer its long-poll
+                if self.changelogs[t].changed_by_others(start, self.committed, sim):
+                    return True
+            elif t in self.subsets:
+                # Subsets without a predicate may change with any write
+                if self.updates4sim[sim][t].seen != self.committed:
+                    return True
+        return False
+
+    def wait_for_updates(self, sim, types, timeout, cancelled=None):
+        '''
+        Blocks until one of the types has changes for simulator sim, or
+        timeout seconds have passed, or cancelled() is true after a wake.
+        Returns True if there are changes.
+        types: [ (type, tracked_only) ]
+        '''
+        deadline = time.time() + timeout
+        with self.changed:
+            while not self.has_updates(sim, types):
+                remaining = deadline - time.time()
+                if remaining <= 0 or (cancelled and cancelled()):
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def wake(self):
+        # Has the waits of wait_for_updates check their cancellation
+        with self.changed:
+            self.changed.notify_all()
+
+    ######################################################
+    ## Writes
+    ######################################################
+    def insert(self, obj, sim):
+        self.commit(sim, {obj.__class__ : [obj]}, {}, {})
+
+    def apply_insert(self, obj, sim, version):
+        newobjs = []
+        cls = obj.__class__
+        # Only accepts inserts of sets and permutations
+        if cls not in self.store:
+            # self.store[obj.__class__] = {}
+            self.__Logger.error("ERROR! Object type supposed to exist in store")
+            return False
+        if obj._primarykey in self.store[cls]:
+            # new = True
+            self.__Logger.error("ERROR! Insert should only be used for new items")
+            return False
+
+        # if this class is a permutation of others, create permutations
+        if hasattr(obj, "__dimensiontable__"):
+            # newobj is the object we will keep in the Store
+            # it is just a dictionary of property -> other objects in store
+            obj, newobjs = self.CreatePermutationObject(obj)
+            self.store[cls][obj._primarykey] = obj
+        else:
+            self.store[cls][obj._primarykey] = deepcopy(obj)
 
-            for o in newobjs:
-                for s in self.updates4sim.keys():
-                    if hasattr(o, "_originalcls"):
-                        self.updates4sim[s][o._originalcls].add(o)
-                    else:
-                        self.updates4sim[s][o.__class__].add(o)
-# #
+        # Objects created for the permutation are new to every simulator
+        for o in newobjs:
+            if hasattr(o, "_originalcls"):
+                self.record(o._originalcls, o._primarykey, None, version, INSERTED)
+            else:
+                self.record(o.__class__, o._primarykey, None, version, INSERTED)
+        self.record(cls, obj._primarykey, sim, version, INSERTED)
 
     def CreatePermutationObject(self, obj):
         storageobj = StorageObjectFactory(obj)
@@ -239,98 +618,190 @@ class SimpleStore(IStore):
         return storageobj, newobjs
 
     def update(self, t, update_dict, sim):
+        self.commit(sim, {}, {}, {t : update_dict})
+
+    def apply_update(self, t, update_dict, sim, version):
         # update_dict: { primary_key : { property_name : property_value } }
         for primkey in update_dict.keys():
             if primkey not in self.store[t]:
                 self.__Logger.info("could not find key %s in store for type %s", primkey, t)
-                return None
+                continue
 
             obj = self.store[t][primkey]
             updates = update_dict[primkey]
+            # Permutations are sent whole
+            props = None if hasattr(obj, "objectlinks") else tuple(updates)
             for pname in updates:
                 if hasattr(obj, "objectlinks"):
                     try:
                         # cls = typeObj.__dimensiontable__[pname]
                         pobj = self.store[obj._originalcls][primkey]
-                        setattr(pobj, pname, updates[pname])
+                        setattr(pobj, pname, private(updates[pname]))
                     except:
                         self.__Logger.exception("Something went wrong.")
                 else:
-                    setattr(obj, pname, updates[pname])
-
-            # TODO: There's a better way of doing this..
-            for s in self.updates4sim.keys():
-                if s != sim:
-                    self.updates4sim[s][t].update(obj)
+                    # The writer keeps its own value
+                    setattr(obj, pname, private(updates[pname]))
+            self.record(t, primkey, sim, version, UPDATED, props)
 
     def update_all(self, pushlist, sim):
-        for t in pushlist.keys():
-            self.update(t, pushlist[t], sim)
+        self.commit(sim, {}, {}, pushlist)
+
+    def delete(self, typeObj, primkey, sim):
+        self.commit(sim, {}, {typeObj : [primkey]}, {})
+
+    def insert_all(self, t, objs, sim):
+        # All or nothing: a bad object rejects the whole list
+        self.commit(sim, {t : objs}, {}, {}, check=True)
+
+    def delete_all(self, t, primkeys, sim):
+        self.commit(sim, {}, {t : primkeys}, {})
 
+    def apply_delete(self, typeObj, primkey, sim, version):
+        if primkey in self.store[typeObj]:
+            del self.store[typeObj][primkey]
+            self.record(typeObj, primkey, sim, version, DELETED)
+        else:
+            self.__Logger.debug("deleted object type %s ID %s missing from store", typeObj, primkey)
+
+    ######################################################
+    ## Reads
+    ######################################################
     def get(self, typeObj, copy_objs=True):
-        with self.lock:
-            if typeObj in self.store:
-                if typeObj in permutationsets:
-                    res = []
-                    for o in self.store[typeObj].values():
-                        res.append(PermutationObjectfactory(o))
-                    # self.__Logger.warn("Retrieving permuted sets not yet implemented.")
-                    return res
-                else:
-                    if copy_objs:
-                        ret = []
-                        for obj in self.store[typeObj].values():
-                            ret.append(copy(obj))
-                        return ret
-                    else:
-                        return self.store[typeObj].values()
-            elif typeObj in self.subsets:
-                if hasattr(self, "instruments"):
-                    header = 'query_%s' % typeObj._FULLNAME
-                    res = self.measure_function(typeObj.query, [self], header)
-                else:
-                    res = typeObj.query(self)
-                return res
+        # Reads the committed version (or the one the caller's pull is pinned to)
+        version = self.readversion()
+        if typeObj in self.store:
+            objs = self.committed_objects(typeObj, version)
+            if copy_objs:
+                return [private_copy(o) for o in objs]
+            return objs
+        elif typeObj in self.views:
+            return set(o.ID for o in self.committed_objects(schema.setsof[typeObj], version) if typeObj.predicate(o))
+        elif typeObj in self.subsets:
+            if hasattr(self, "instruments"):
+                header = 'query_%s' % typeObj._FULLNAME
+                res = self.measure_function(typeObj.query, [self], header)
             else:
-                self.__Logger.error("ERROR! Object type supposed to exist as a set or subset")
-                sys.exit(0)
+                res = typeObj.query(self)
+            return res
+        else:
+            self.__Logger.error("ERROR! Object type supposed to exist as a set or subset")
+            sys.exit(0)
 
     def getobj(self, typeObj, key):
-        if key in self.store[typeObj]:
-            return copy(self.store[typeObj][key])
+        obj = self.at(typeObj, key, self.readversion())
+        if obj is not None:
+            return private_copy(obj)
         else:
             self.__Logger.error("Could not find key %s for object type %s", key, typeObj)
 
-    def getupdated(self, typeObj, sim, copy_objs=True, tracked_only=False):
-        with self.lock:
-            if typeObj in self.subsets:
+    def getupdated(self, typeObj, sim, copy_objs=True, tracked_only=False, deltas=False):
+        '''
+        Objects of typeObj new, updated and deleted since sim last read it.
+        deltas: updated objects come as Deltas of the properties changed
+        since, when known
+        '''
+        version = self.readversion(sim)
+        if typeObj in self.changelogs:
+            new_objs, mod_objs, del_objs = self.changes(typeObj, sim, version, copy_objs, deltas)
+        else:
+            # Subset queries read the same version as the rest of the pull
+            tracker = self.updates4sim[sim][typeObj]
+            self.reader.version = version
+            try:
                 if hasattr(self, "instruments"):
                     header = 'query_%s' % typeObj._FULLNAME
                     res = self.measure_function(typeObj.query, [self], header)
                 else:
                     res = typeObj.query(self)
-                if tracked_only:
-                    new_objs, _, del_objs = self.updates4sim[sim][typeObj].get_update(res)
-                    return new_objs, [], del_objs
+            finally:
+                del self.reader.version
+            new_objs, mod_objs, del_objs = tracker.get_update(res, self.changelogs[tracker.objtype], version)
+        if tracked_only:
+            return new_objs, [], del_objs
+        return new_objs, mod_objs, del_objs
+
+    def changes(self, t, sim, version, copy_objs, deltas=False):
+        '''
+        Changes of type t made by other simulators since sim last read it,
+        up to version. For views, lists of keys are returned.
+        '''
+        cursors = self.cursors[sim]
+        log = self.changelogs[t]
+        if t in self.views:
+            # A view's first read returns its whole membership
+            start = cursors.get(t, 0)
+        else:
+            start = cursors.get(t, self.registered[sim])
+        cursors[t] = version
+
+        if start < log.floor:
+            # Changes since start were reclaimed: send everything
+            if t in self.views:
+                return [o.ID for o in self.committed_objects(schema.setsof[t], version) if t.predicate(o)], [], []
+            return self.objects_at(t, self.chains[t].keys(), version, copy_objs), [], []
+
+        new = {}
+        # Updated key -> names of the properties changed, None for all
+        mod = {}
+        deleted = set()
+        for _, wsim, primkey, kind, props in log.since(start, version):
+            if wsim == sim:
+                continue
+            if kind == INSERTED:
+                if primkey in deleted:
+                    # Deleted and inserted again
+                    deleted.remove(primkey)
+                    mod[primkey] = None
                 else:
-                    return self.updates4sim[sim][typeObj].get_update(res)
+                    new[primkey] = True
+            elif kind == UPDATED:
+                if primkey not in new:
+                    if props is None:
+                        mod[primkey] = None
+                    elif primkey not in mod:
+                        mod[primkey] = set(props)
+                    elif mod[primkey] is not None:
+                        mod[primkey].update(props)
             else:
-                if tracked_only:
-                    new_objs, _, del_objs = self.updates4sim[sim][typeObj].updatelist(clear=True, copy_objs=copy_objs)
-                    return new_objs, [], del_objs
+                if primkey in new:
+                    # Inserted and deleted since the last read
+                    del new[primkey]
                 else:
-                    return self.updates4sim[sim][typeObj].updatelist(clear=True, copy_objs=copy_objs)
-
-    def delete(self, typeObj, primkey, sim):
-        with self.lock:
-            if primkey in self.store[typeObj]:
-                del self.store[typeObj][primkey]
-                # TODO: There's a better way of doing this..
-                for s in self.updates4sim.keys():
-                    if s != sim:
-                        self.updates4sim[s][typeObj].delete(primkey)
+                    mod.pop(primkey, None)
+                    deleted.add(primkey)
+
+        if t in self.views:
+            return new.keys(), mod.keys(), list(deleted)
+        if deltas:
+            return self.objects_at(t, new, version, copy_objs), self.deltas_at(t, mod, version, copy_objs), list(deleted)
+        return self.objects_at(t, new, version, copy_objs), self.objects_at(t, mod, version, copy_objs), list(deleted)
+
+    def objects_at(self, t, keys, version, copy_objs):
+        res = []
+        for primkey in keys:
+            obj = self.at(t, primkey, version)
+            # Deleted later by the reader itself
+            if obj is None:
+                continue
+            res.append(private_copy(obj) if copy_objs else obj)
+        return res
+
+    def deltas_at(self, t, mod, version, copy_objs):
+        # mod: { primary_key : property names, None for the whole object }
+        res = []
+        for primkey, props in mod.items():
+            obj = self.at(t, primkey, version)
+            if obj is None:
+                continue
+            if props is None:
+                res.append(private_copy(obj) if copy_objs else obj)
             else:
-                self.__Logger.debug("deleted object type %s ID %s missing from store", typeObj, primkey)
+                values = dict((name, getattr(obj, name)) for name in props)
+                if copy_objs:
+                    values = dict((name, private(value)) for name, value in values.items())
+                res.append(Delta(primkey, obj._version, values))
+        return res
 
     def count(self, typeObj):
         return len(self.store[typeObj])
@@ -339,51 +810,81 @@ class SimpleStore(IStore):
         return
 
 class InstrumentedSimpleStore(SimpleStore):
+    '''
+    SimpleStore timing its operations per type. Every timing goes to a
+    latency histogram (see latency), kept for the life of the store; the
+    get and getupdated timings also make the per interval means returned
+    by collect_instruments.
+    '''
     def __init__(self):
         self.instruments = {}
+        self.latency = Histograms()
         super(InstrumentedSimpleStore, self).__init__()
         for ss in self.subsets:
-            self.instruments['query_%s' % ss._FULLNAME] = []
-            self.instruments['get_%s' % ss._FULLNAME] = []
-            self.instruments['getupdated_%s' % ss._FULLNAME] = []
+            self.instruments['query_%s' % ss._FULLNAME] = ""
+            self.instruments['get_%s' % ss._FULLNAME] = ""
+            self.instruments['getupdated_%s' % ss._FULLNAME] = ""
         for t in self.store:
-            self.instruments['get_%s' % t._FULLNAME] = []
-            self.instruments['getupdated_%s' % t._FULLNAME] = []
+            self.instruments['get_%s' % t._FULLNAME] = ""
+            self.instruments['getupdated_%s' % t._FULLNAME] = ""
+        # header -> [ total ms, count ] since the last collect_instruments
+        self.interval = {}
+
+    def measure(self, header, start):
+        end = time.time()
+        tracing.record(header, start, end, "store")
+        ms = (end - start) * 1000
+        self.latency.record(header, ms)
+        if header in self.instruments:
+            acc = self.interval.setdefault(header, [0.0, 0])
+            acc[0] += ms
+            acc[1] += 1
 
     def get(self, typeObj, copy_objs=True):
         start = time.time()
-        ret = super(InstrumentedSimpleStore, self).get(typeObj, copy_objs=True)
-        end = time.time()
-        header = 'get_%s' % typeObj._FULLNAME
-        if self.instruments[header] == "":
-            self.instruments[header] = []
-        self.instruments[header].append((end-start) * 1000)
+        ret = super(InstrumentedSimpleStore, self).get(typeObj, copy_objs)
+        self.measure('get_%s' % typeObj._FULLNAME, start)
         return ret
 
-    def getupdated(self, typeObj, sim, copy_objs=True, tracked_only=False):
+    def getupdated(self, typeObj, sim, copy_objs=True, tracked_only=False, deltas=False):
         start = time.time()
-        ret = super(InstrumentedSimpleStore, self).getupdated(typeObj, sim, copy_objs, tracked_only)
-        end = time.time()
-        header = 'getupdated_%s' % typeObj._FULLNAME
-        if self.instruments[header] == "":
-            self.instruments[header] = []
-        self.instruments[header].append((end-start) * 1000)
+        ret = super(InstrumentedSimpleStore, self).getupdated(typeObj, sim, copy_objs, tracked_only, deltas)
+        self.measure('getupdated_%s' % typeObj._FULLNAME, start)
         return ret
 
+    def commit(self, sim, inserts, deletes, updates, check=False):
+        start = time.time()
+        super(InstrumentedSimpleStore, self).commit(sim, inserts, deletes, updates, check)
+        self.measure('commit', start)
+
+    def apply_insert(self, obj, sim, version):
+        start = time.time()
+        ret = super(InstrumentedSimpleStore, self).apply_insert(obj, sim, version)
+        self.measure('insert_%s' % obj.__class__._FULLNAME, start)
+        return ret
+
+    def apply_update(self, t, update_dict, sim, version):
+        start = time.time()
+        super(InstrumentedSimpleStore, self).apply_update(t, update_dict, sim, version)
+        self.measure('update_%s' % t._FULLNAME, start)
+
+    def apply_delete(self, typeObj, primkey, sim, version):
+        start = time.time()
+        super(InstrumentedSimpleStore, self).apply_delete(typeObj, primkey, sim, version)
+        self.measure('delete_%s' % typeObj._FULLNAME, start)
+
     def measure_function(self, f, args, header, average=True):
         start = time.time()
         ret = f(*args)
-        end = time.time()
-        if average and self.instruments[header] == "":
-            self.instruments[header] = []
-            self.instruments[header].append((end - start) * 1000)
-        else:
-            if self.instruments[header] == "":
-                self.instruments[header] = 0
-            self.instruments[header].append((end - start) * 1000)
+        self.measure(header, start)
         return ret
+
+    def latency_summary(self):
+        return self.latency.summary()
+
     def collect_instruments(self):
-        insts = copy(self.instruments)
-        for h in self.instruments:
-            self.instruments[h] = ""
+        insts = dict.fromkeys(self.instruments, "")
+        interval, self.interval = self.interval, {}
+        for h, (total, count) in interval.items():
+            insts[h] = total / count
         return insts
@@ -48,6 +48,8 @@ sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "
 
 import platform, time
 
+from cadis.common.scheduler import DEFAULT_INTERVAL
+
 # XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX
 # XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX
 class BaseConnector :
@@ -60,7 +62,7 @@ class BaseConnector :
         self.CurrentStep = 0
 
         # Get world time
-        self.Interval =  float(settings["General"].get("Interval", 0.150))
+        self.Interval =  float(settings["General"].get("Interval", DEFAULT_INTERVAL))
         self.SecondsPerStep = float(settings["General"].get("SecondsPerStep", 2.0))
         self.StartTimeOfDay = float(settings["General"].get("StartTimeOfDay", 8.0))
         self.RealDayLength = 24.0 * self.Interval / self.SecondsPerStep
@@ -48,8 +48,12 @@ import EventRouter, EventTypes
 import SumoConnector, OpenSimConnector, SocialConnector, StatsConnector
 from cadis.frame import Frame
 import cadis.frame as frame_module
-from cadis.store.remotestore import RemoteStore, PythonRemoteStore
+from cadis.store.remotestore import RemoteStore, PythonRemoteStore, BatchedRemoteStore, \
+    SubscribingRemoteStore
 from cadis.store.simplestore import SimpleStore
+from cadis.store.sharedstore import SharedMemoryStore, SEGMENT_SIZE
+from cadis.common.scheduler import TickBarrier
+from cadis.common.histogram import format_summary
 from mobdat.common import LayoutSettings, WorldInfo
 from mobdat.common.Utilities import AuthByUserName
 from prime import PrimeSimulator
@@ -94,7 +98,7 @@ class MobdatController(cmd.Cmd) :
         self.cmds = cmd_dict
         self.autostart = autostart
         self.wait2start = False
-
+
     def start_loop(self):
         self.ready = False
         while(not self.ready and self.cmds["SimulatorStartup"] == False):
@@ -165,6 +169,55 @@ class MobdatController(cmd.Cmd) :
 
         self.cmds["SimulatorPaused"] = False
 
+    # -----------------------------------------------------------------
+    def do_latency(self, args) :
+        """latency [application]
+        Print the latency percentiles of the frame phases of every application
+        (or of the one given), and of the store operations
+        """
+        pargs = args.split()
+        found = False
+        for k, v in sorted(self.cmds.items()):
+            if k.startswith("LATENCY_") and (not pargs or k[len("LATENCY_"):] in pargs):
+                print "## %s" % k[len("LATENCY_"):]
+                print format_summary(v)
+                found = True
+        if not found:
+            print 'No latencies published yet; they are published once the simulation runs'
+        if not pargs and hasattr(Frame.Store, "latency_summary"):
+            try:
+                summary = Frame.Store.latency_summary()
+            except Exception:
+                self.__Logger.exception("could not read the store latencies")
+            else:
+                print "## store"
+                print format_summary(summary)
+
+    # -----------------------------------------------------------------
+    def do_profile(self, args) :
+        """profile application|all start [interval_ms] | profile application|all stop
+        Start or stop sampling the stack of a running application, every
+        interval_ms milliseconds (5 by default). Stopping writes the samples
+        as collapsed stacks (stats/*.folded) for flame graphs
+        """
+        pargs = args.split()
+        apps = [k[len("APP_"):] for k in self.cmds.keys() if k.startswith("APP_")]
+        try :
+            if pargs[0] != "all" and pargs[0] not in apps:
+                raise ValueError(pargs[0])
+            targets = apps if pargs[0] == "all" else [pargs[0]]
+            if pargs[1] == "start":
+                interval = float(pargs[2]) if len(pargs) > 2 else 5.0
+            elif pargs[1] == "stop":
+                interval = 0
+            else:
+                raise ValueError(pargs[1])
+        except (IndexError, ValueError):
+            print 'Unable to parse input parameter %s; applications are %s' % (args, ", ".join(sorted(apps)))
+            return
+        for app in targets:
+            self.cmds["PROFILE_" + app] = interval
+
     # -----------------------------------------------------------------
     def do_exit(self, args) :
         """exit
@@ -203,9 +256,13 @@ def Controller(settings) :
 
     cnames = settings["General"].get("Connectors", ['sumo', 'opensim', 'social', 'stats'])
     store_type = settings["General"].get("Store", "SimpleStore")
+    codec = settings["General"].get("Codec", "json")
+    # http://host:port, or unix:///path for a frame server on a Unix domain socket
+    address = settings["General"].get("FrameServer", "http://localhost:12000")
     process = settings["General"].get("MultiProcessing", False)
     timer = settings["General"].get("Timer", None)
     autostart = settings["General"].get("AutoStart", False)
+    lockstep = settings["General"].get("LockStep", False)
     if timer:
         seconds = 0
         minutes = 0
@@ -220,7 +277,7 @@ def Controller(settings) :
 
     connectors = []
 
-    if store_type == "RemoteStore":
+    if store_type in ("RemoteStore", "BatchedRemoteStore", "SubscribingRemoteStore", "SharedMemoryStore"):
         manager = Manager()
         cmd_dict = manager.dict()
     else:
@@ -232,8 +289,14 @@ def Controller(settings) :
 
     if store_type == "RemoteStore":
         Store = PythonRemoteStore
+    elif store_type == "BatchedRemoteStore":
+        Store = BatchedRemoteStore
+    elif store_type == "SubscribingRemoteStore":
+        Store = SubscribingRemoteStore
     elif store_type == "SimpleStore":
         Store = SimpleStore
+    elif store_type == "SharedMemoryStore":
+        Store = SharedMemoryStore
     else: #default to SimpleStore
         Store = SimpleStore
 
@@ -241,17 +304,29 @@ def Controller(settings) :
         logger.warn("Cannot use multiprocessing with SimpleStore. Continuing with Threading.")
         process = False
 
+    barrier = None
+    if lockstep:
+        # Every connector ticks once per step, without sleeping in between
+        barrier = TickBarrier(len([c for c in cnames if c in _SimulationControllers]))
+        logger.warn("running in lock-step mode")
+
     for cname in cnames :
         if cname not in _SimulationControllers :
             logger.warn('skipping unknown simulation connector; %s' % (cname))
             continue
 
-        cframe = Frame(Store(), process, settings)
+        if Store == SimpleStore:
+            cframe = Frame(Store(), process, settings)
+        elif Store == SharedMemoryStore:
+            # Created before the connector processes start, which inherit it
+            cframe = Frame(Store(int(settings["General"].get("SharedMemorySize", SEGMENT_SIZE))), process, settings)
+        else:
+            cframe = Frame(Store(address, codec=codec), process, settings)
         cmd_dict["APP_" + _SimulationControllers[cname].__name__] = "Initializing"
         connector = _SimulationControllers[cname](settings, world, laysettings, cname, cframe)
         cframe.attach(connector)
         connectors.append(cframe)
-        cframe.go(cmd_dict, timer)
+        cframe.go(cmd_dict, timer, barrier)
 
     controller = MobdatController(logger, connectors, cmd_dict, autostart)
     controller.cmdloop()
@@ -10,10 +10,14 @@ from collections import namedtuple
 from cadis.frame import Frame
 import uuid
 from mobdat.common.ValueTypes import Quaternion, Vector3
+from cadis.language.codec import register_value_type
 
 logger = logging.getLogger(__name__)
 LOG_HEADER = "[DATAMODEL]"
 
+register_value_type(Vector3, ('x', 'y', 'z'))
+register_value_type(Quaternion, ('x', 'y', 'z', 'w'))
+
 class Capsule(object):
     def __init__(self, sname = None, dname = None):
         self.SourceName = sname
@@ -377,9 +381,13 @@ class Vehicle(CADIS):
 
 @SubSet(Vehicle)
 class MovingVehicle(Vehicle):
+    @staticmethod
+    def predicate(c):
+        return c.Position != None or c.Position != (0,0,0)
+
     @staticmethod
     def query(store):
-        return set([c.ID for c in store.get(Vehicle, False) if c.Position != None or c.Position != (0,0,0)])  # @UndefinedVariable
+        return set([c.ID for c in store.get(Vehicle, False) if MovingVehicle.predicate(c)])  # @UndefinedVariable
 
 if __name__ == "__main__":
     test = ResidentialNode()
@@ -0,0 +1,6 @@
+'''
+Behavior tests of the CADIS frame and stores. Run from the repository root
+with Python 2.7:
+
+    python -m unittest discover -s tests -t .
+'''
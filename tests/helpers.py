@@ -0,0 +1,33 @@
+'''
+Fixtures shared by the tests.
+'''
+import itertools
+import threading
+
+from cadis.store.simplestore import SimpleStore
+from mobdat.common.ValueTypes import Vector3
+from mobdat.simulator.DataModel import Vehicle
+
+def fresh_store():
+    '''
+    A new, empty SimpleStore. The store is a singleton keeping its data
+    in class attributes, which are reset here.
+    '''
+    for cls in SimpleStore.__subclasses__() + [SimpleStore]:
+        if "__singleton__" in cls.__dict__:
+            delattr(cls, "__singleton__")
+    SimpleStore.store = {}
+    SimpleStore.subsets = {}
+    SimpleStore.chains = {}
+    SimpleStore.changelogs = {}
+    SimpleStore.views = {}
+    SimpleStore.locks = {}
+    SimpleStore.versionclock = itertools.count(1)
+    SimpleStore.changed = threading.Condition(threading.Lock())
+    return SimpleStore()
+
+def vehicle(name):
+    v = Vehicle()
+    v.Name = name
+    v.Position = Vector3(1, 2, 3)
+    return v
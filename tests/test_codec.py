@@ -0,0 +1,65 @@
+'''
+BinaryCodec: values, objects and pre-encoded values read back as written.
+'''
+import unittest
+from uuid import uuid4
+
+from cadis.language.codec import BinaryCodec
+from mobdat.common.ValueTypes import Vector3
+from mobdat.simulator.DataModel import Vehicle
+from tests.helpers import vehicle
+
+class BinaryCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = BinaryCodec()
+
+    def roundtrip(self, value):
+        return self.codec.loads(self.codec.dumps(value))
+
+    def assertSameVehicle(self, obj, v):
+        self.assertIsInstance(obj, Vehicle)
+        self.assertEqual(obj.ID, v.ID)
+        self.assertEqual(obj.Name, v.Name)
+        self.assertIsInstance(obj.Position, Vector3)
+        self.assertEqual((obj.Position.x, obj.Position.y, obj.Position.z),
+                         (v.Position.x, v.Position.y, v.Position.z))
+
+    def test_values(self):
+        msg = {"none" : None, "bool" : True, "int" : -5, "long" : 1 << 70, "float" : 1.5,
+               "str" : "abc", "unicode" : u"\xe9t\xe9", "uuid" : uuid4(),
+               "list" : [1, [2, 3]], "dict" : {"x" : {}}}
+        self.assertEqual(self.roundtrip(msg), msg)
+
+    def test_sequences_read_as_lists(self):
+        self.assertEqual(self.roundtrip((1, 2)), [1, 2])
+
+    def test_object(self):
+        v = vehicle("a")
+        v._version = 7
+        obj = self.roundtrip(v)
+        self.assertSameVehicle(obj, v)
+        self.assertEqual(obj._version, 7)
+
+    def test_objects_of_a_list(self):
+        vs = [vehicle("a"), vehicle("b")]
+        objs = self.roundtrip({"insert" : {Vehicle._FULLNAME : vs}})["insert"][Vehicle._FULLNAME]
+        self.assertEqual(len(objs), 2)
+        for obj, v in zip(objs, vs):
+            self.assertSameVehicle(obj, v)
+
+    def test_encoded(self):
+        # Encoded once, then embedded in several messages
+        v = vehicle("a")
+        encoded = self.codec.encode([v])
+        for _ in range(2):
+            objs = self.roundtrip({"updated" : encoded})["updated"]
+            self.assertSameVehicle(objs[0], v)
+
+    def test_decode_props(self):
+        props = self.codec.decode_props(Vehicle, {"Position" : {"x" : 1, "y" : 2, "z" : 3}, "Name" : "a"})
+        self.assertIsInstance(props["Position"], Vector3)
+        self.assertEqual(props["Position"].y, 2)
+        self.assertEqual(props["Name"], "a")
+
+if __name__ == "__main__":
+    unittest.main()
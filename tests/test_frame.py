@@ -0,0 +1,88 @@
+'''
+Frame: updates read as Deltas.
+'''
+import unittest
+
+from cadis.common.IFramed import IFramed, Producer, GetterSetter, Getter
+from cadis.frame import Frame
+from cadis.language.schema import schema_data
+from mobdat.common.ValueTypes import Vector3
+from mobdat.simulator.DataModel import Vehicle
+from tests.helpers import fresh_store, vehicle
+
+@Producer(Vehicle)
+@GetterSetter(Vehicle)
+class Writer(IFramed):
+    def __init__(self, frame):
+        self.frame = frame
+
+    def initialize(self):
+        for i in range(3):
+            self.frame.add(vehicle("v%d" % i))
+
+    def update(self):
+        for v in self.frame.get(Vehicle):
+            v.Position = Vector3(v.Position.x + 1, 0, 0)
+
+    def shutdown(self):
+        return
+
+@Getter(Vehicle)
+class Reader(IFramed):
+    def __init__(self, frame):
+        self.frame = frame
+
+    def initialize(self):
+        return
+
+    def update(self):
+        return
+
+    def shutdown(self):
+        return
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = Frame.Store
+        store = fresh_store()
+        cmds = {"SimulatorStartup" : True, "SimulatorShutdown" : False, "SimulatorPaused" : False}
+        self.writer = Frame(store)
+        self.writer.attach(Writer(self.writer))
+        self.reader = Frame(store)
+        self.reader.attach(Reader(self.reader))
+        for frame in (self.writer, self.reader):
+            frame.cmds = cmds
+        self.use(self.writer).app.initialize()
+        self.writer.push()
+        self.use(self.reader).pull()
+
+    def tearDown(self):
+        Frame.Store = self.saved
+
+    def use(self, frame):
+        # Property setters find the frame running through schema_data
+        schema_data.frame = frame
+        return frame
+
+    def tick(self):
+        self.use(self.writer).pull()
+        self.writer.app.update()
+        self.writer.push()
+        self.use(self.reader).pull()
+
+    def test_applied_to_buffered_object(self):
+        self.tick()
+        positions = [o.Position.x for o in self.reader.changed(Vehicle)]
+        self.assertEqual(positions, [2, 2, 2])
+
+    def test_refetch_of_unknown_object(self):
+        lost = self.reader.get(Vehicle)[0].ID
+        del self.reader.storebuffer[Vehicle][lost]
+        self.tick()
+        self.assertIn(lost, self.reader.storebuffer[Vehicle])
+        self.assertIn(lost, self.reader.new_storebuffer[Vehicle])
+        self.assertEqual(self.reader.storebuffer[Vehicle][lost].Position.x, 2)
+        self.assertEqual(len(self.reader.changed(Vehicle)), 2)
+
+if __name__ == "__main__":
+    unittest.main()
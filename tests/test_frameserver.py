@@ -0,0 +1,37 @@
+'''
+Frame server: a sync whose writes the store rejects.
+'''
+import unittest
+
+from cadis import frameserver
+from cadis.language.codec import BinaryCodec
+from mobdat.simulator.DataModel import Vehicle
+from tests.helpers import fresh_store, vehicle
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = frameserver.FrameServer.Store
+        self.store = fresh_store()
+        self.store.register("W")
+        frameserver.FrameServer.Store = self.store
+        self.codec = BinaryCodec()
+
+    def tearDown(self):
+        frameserver.FrameServer.Store = self.saved
+
+    def sync(self, inserts):
+        msg = {"insert" : {Vehicle._FULLNAME : inserts}, "delete" : {}, "update" : {},
+               "observe" : [(Vehicle._FULLNAME, False)], "deltas" : False}
+        with frameserver.app.test_request_context("/W/sync", method="POST", data=self.codec.dumps(msg),
+                                                  content_type=self.codec.content_type):
+            return frameserver.Sync().post("W")
+
+    def test_rejected_as_a_whole(self):
+        b = vehicle("b")
+        body, status = self.sync([vehicle("a"), b, b])
+        self.assertEqual(status, 400)
+        self.assertIn("twice", body["error"])
+        self.assertEqual(self.store.get(Vehicle), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+'''
+SharedMemoryStore: commits of other processes reach the replica, and
+simulators read from other processes do not hold back its reclaim.
+'''
+import multiprocessing
+import unittest
+
+from cadis.store.sharedstore import SharedMemoryStore
+from mobdat.common.ValueTypes import Vector3
+from mobdat.simulator.DataModel import Vehicle
+from tests.helpers import fresh_store, vehicle
+
+def reset_shared():
+    # The segment and the replica are created by the first store
+    SharedMemoryStore.segment = None
+    SharedMemoryStore.lock = None
+    SharedMemoryStore.replica = None
+    SharedMemoryStore.replayed = 0
+    SharedMemoryStore.hosted = set()
+
+class SharedMemoryStoreTest(unittest.TestCase):
+    VEHICLES = 20
+    TICKS = 100
+
+    def setUp(self):
+        fresh_store()
+        reset_shared()
+        self.store = SharedMemoryStore(size=1, entries=1024)
+        # As in the Controller, every simulator registers before the fork
+        for sim in ("W", "R", "Other"):
+            self.store.register(sim)
+
+    def tearDown(self):
+        reset_shared()
+
+    def pull(self, sim):
+        self.store.pin(sim)
+        try:
+            return self.store.getupdated(Vehicle, sim)
+        finally:
+            self.store.unpin(sim)
+
+    def test_commits_of_other_processes_are_replayed(self):
+        writer = multiprocessing.Process(target=self.store.insert, args=(vehicle("a"), "Other"))
+        writer.start()
+        writer.join()
+        new, _, _ = self.pull("R")
+        self.assertEqual([o.Name for o in new], ["a"])
+
+    def test_sims_read_elsewhere_do_not_hold_back(self):
+        keys = []
+        for i in range(self.VEHICLES):
+            v = vehicle("v%d" % i)
+            self.store.insert(v, "W")
+            keys.append(v.ID)
+        for n in range(self.TICKS):
+            updates = dict((key, {"Position" : Vector3(n, 0, 0)}) for key in keys)
+            self.store.update(Vehicle, updates, "W")
+            self.pull("W")
+            self.pull("R")
+        log = self.store.replica.changelogs[Vehicle]
+        self.assertLessEqual(len(log.entries[0]), 2 * self.VEHICLES)
+
+if __name__ == "__main__":
+    unittest.main()
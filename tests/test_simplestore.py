@@ -0,0 +1,146 @@
+'''
+SimpleStore: versions, copies handed to readers and writers.
+'''
+import unittest
+
+from mobdat.common.ValueTypes import Vector3
+from mobdat.simulator.DataModel import Vehicle, MovingVehicle
+from tests.helpers import fresh_store, vehicle
+
+class PrivateValuesTest(unittest.TestCase):
+    '''
+    Readers and writers get their own value objects: changing a Vector3 in
+    place does not change the store's versions.
+    '''
+    def setUp(self):
+        self.store = fresh_store()
+        for sim in ("W", "R"):
+            self.store.register(sim)
+        self.v = vehicle("a")
+        self.store.insert(self.v, "W")
+
+    def position(self):
+        return self.store.get(Vehicle)[0].Position
+
+    def test_get(self):
+        self.store.get(Vehicle)[0].Position.x = 999
+        self.assertEqual(self.position().x, 1)
+
+    def test_getupdated(self):
+        new, _, _ = self.store.getupdated(Vehicle, "R")
+        new[0].Position.x = 999
+        self.assertEqual(self.position().x, 1)
+
+    def test_writer_value(self):
+        p = Vector3(7, 7, 7)
+        self.store.update(Vehicle, {self.v.ID : {"Position" : p}}, "W")
+        p.x = 999
+        self.assertEqual(self.position().x, 7)
+
+    def test_delta(self):
+        self.store.getupdated(Vehicle, "R")
+        self.store.update(Vehicle, {self.v.ID : {"Position" : Vector3(7, 7, 7)}}, "W")
+        _, mod, _ = self.store.getupdated(Vehicle, "R", deltas=True)
+        mod[0].props["Position"].y = 999
+        self.assertEqual(self.position().y, 7)
+
+class InsertAllTest(unittest.TestCase):
+    '''
+    A bulk insert, or a checked commit, is applied as a whole or not at all.
+    '''
+    def setUp(self):
+        self.store = fresh_store()
+        self.store.register("W")
+        self.v = vehicle("a")
+        self.store.insert(self.v, "W")
+
+    def names(self):
+        return sorted(o.Name for o in self.store.get(Vehicle))
+
+    def test_key_in_store(self):
+        dup = vehicle("dup")
+        dup.ID = self.v.ID
+        self.assertRaises(ValueError, self.store.insert_all, Vehicle, [vehicle("b"), dup], "W")
+        self.assertEqual(self.names(), ["a"])
+
+    def test_key_twice(self):
+        b = vehicle("b")
+        self.assertRaises(ValueError, self.store.insert_all, Vehicle, [b, b], "W")
+        self.assertEqual(self.names(), ["a"])
+
+    def test_checked_commit(self):
+        b = vehicle("b")
+        updates = {Vehicle : {self.v.ID : {"Name" : "renamed"}}}
+        self.assertRaises(ValueError, self.store.commit, "W", {Vehicle : [b, b]}, {}, updates, check=True)
+        self.assertEqual(self.names(), ["a"])
+
+    def test_valid_list(self):
+        self.store.insert_all(Vehicle, [vehicle("b"), vehicle("c")], "W")
+        self.assertEqual(self.names(), ["a", "b", "c"])
+
+class ReclaimTest(unittest.TestCase):
+    '''
+    Versions and change log entries every simulator has read are reclaimed,
+    for sets and for predicate views.
+    '''
+    VEHICLES = 50
+    TICKS = 200
+
+    def setUp(self):
+        self.store = fresh_store()
+        for sim in ("W", "R"):
+            self.store.register(sim)
+        self.keys = []
+        for i in range(self.VEHICLES):
+            v = vehicle("v%d" % i)
+            self.store.insert(v, "W")
+            self.keys.append(v.ID)
+
+    def pull(self, sim, *types):
+        self.store.pin(sim)
+        try:
+            for t in types:
+                self.store.getupdated(t, sim)
+        finally:
+            self.store.unpin(sim)
+
+    def tick(self, n):
+        updates = dict((key, {"Position" : Vector3(n, 0, 0)}) for key in self.keys)
+        self.store.update(Vehicle, updates, "W")
+
+    def logsize(self, t):
+        return len(self.store.changelogs[t].entries[0])
+
+    def test_logs_and_chains_stay_bounded(self):
+        for n in range(self.TICKS):
+            self.tick(n)
+            self.pull("W", Vehicle)
+            self.pull("R", Vehicle, MovingVehicle)
+        self.assertLessEqual(self.logsize(Vehicle), 2 * self.VEHICLES)
+        self.assertLessEqual(self.logsize(MovingVehicle), 2 * self.VEHICLES)
+        longest = max(len(chain) for chain in self.store.chains[Vehicle].values())
+        self.assertLessEqual(longest, 2)
+
+    def test_pins_are_released(self):
+        self.pull("R", Vehicle)
+        self.assertEqual(self.store.pins, {})
+
+    def test_unread_types_do_not_hold_back(self):
+        # Once they pulled, simulators only hold back the types they read
+        for n in range(self.TICKS):
+            self.tick(n)
+            self.pull("W", Vehicle)
+            self.pull("R", Vehicle)
+        self.assertLessEqual(self.logsize(MovingVehicle), 2 * self.VEHICLES)
+
+    def test_unread_changes_are_kept(self):
+        self.pull("R", Vehicle)
+        for n in range(3):
+            self.tick(n)
+            self.pull("W", Vehicle)
+        _, mod, _ = self.store.getupdated(Vehicle, "R")
+        self.assertEqual(len(mod), self.VEHICLES)
+        self.assertEqual(set(o.Position.x for o in mod), set([2]))
+
+if __name__ == "__main__":
+    unittest.main()
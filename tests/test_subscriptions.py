@@ -0,0 +1,42 @@
+'''
+Long-poll subscriptions: what wakes a subscriber, and the frame server's
+answer to a simulator that did not subscribe.
+'''
+import unittest
+
+from cadis import frameserver
+from mobdat.simulator.DataModel import Vehicle
+from tests.helpers import fresh_store, vehicle
+
+class WaitForUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.store = fresh_store()
+        for sim in ("W", "R"):
+            self.store.register(sim)
+        self.types = [(Vehicle, False)]
+
+    def test_own_writes_do_not_wake(self):
+        self.store.insert(vehicle("a"), "R")
+        self.assertFalse(self.store.has_updates("R", self.types))
+        self.assertFalse(self.store.wait_for_updates("R", self.types, 0.05))
+
+    def test_writes_of_others_wake(self):
+        self.store.insert(vehicle("a"), "W")
+        self.assertTrue(self.store.wait_for_updates("R", self.types, 0.05))
+
+    def test_read_changes_do_not_wake(self):
+        self.store.insert(vehicle("a"), "W")
+        self.store.pin("R")
+        self.store.getupdated(Vehicle, "R")
+        self.assertFalse(self.store.has_updates("R", self.types))
+
+class SubscribeTest(unittest.TestCase):
+    def test_poll_without_subscription(self):
+        frameserver.FrameServer.subscriptions.pop("nobody", None)
+        with frameserver.app.test_request_context("/nobody/subscribe?timeout=0"):
+            body, status = frameserver.Subscribe().get("nobody")
+        self.assertEqual(status, 404)
+        self.assertIn("not subscribed", body["error"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+'''
+Change detection of queried subsets (see SubSetFrameUpdate).
+'''
+import unittest
+import uuid
+
+from cadis.store.simplestore import SubSetFrameUpdate, ChangeLog, UPDATED
+from mobdat.simulator.DataModel import MovingVehicle
+
+class SubSetFrameUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b, self.c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        self.log = ChangeLog()
+        self.tracker = SubSetFrameUpdate(MovingVehicle)
+
+    def test_first_query_returns_members_as_new(self):
+        new, mod, deleted = self.tracker.get_update(set([self.a, self.b]), self.log, 1)
+        self.assertEqual(set(new), set([self.a, self.b]))
+        self.assertEqual((mod, deleted), ([], []))
+
+    def test_modified_members_come_from_the_log(self):
+        self.tracker.get_update(set([self.a, self.b]), self.log, 1)
+        self.log.append(2, "sim", self.a, UPDATED)
+        # A change to an object that is not a member is not reported
+        self.log.append(2, "sim", self.c, UPDATED)
+        new, mod, deleted = self.tracker.get_update(set([self.a, self.b]), self.log, 2)
+        self.assertEqual((new, mod, deleted), ([], [self.a], []))
+
+    def test_membership_changes(self):
+        self.tracker.get_update(set([self.a, self.b]), self.log, 1)
+        new, mod, deleted = self.tracker.get_update(set([self.b, self.c]), self.log, 2)
+        self.assertEqual((new, mod, deleted), ([self.c], [], [self.a]))
+
+    def test_reclaimed_changes_report_every_member(self):
+        self.tracker.get_update(set([self.a, self.b]), self.log, 1)
+        self.log.append(2, "sim", self.a, UPDATED)
+        self.log.append(3, "sim", self.b, UPDATED)
+        self.log.reclaim(3)
+        new, mod, deleted = self.tracker.get_update(set([self.a, self.b]), self.log, 3)
+        self.assertEqual(set(mod), set([self.a, self.b]))
+
+if __name__ == "__main__":
+    unittest.main()